@@ -4,7 +4,7 @@ A standalone client for the Planet Basemaps API.
 import os
 import re
 import json
-import shutil
+import zlib
 import datetime as dt
 import itertools as it
 from concurrent.futures import ThreadPoolExecutor
@@ -13,6 +13,18 @@ import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from download_scheduler import (DownloadScheduler, PRIORITY_INTERACTIVE,
+                                PRIORITY_NORMAL, PRIORITY_BACKFILL)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjson is several times faster at decoding large quad listings
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 
 # GDAL XYZ XML templates for full-bit-depth streaming.
 FULL_BIT_DEPTH_XML = """
@@ -94,16 +106,80 @@ def _chunks(iterable, chunksize):
             return
 
 
+def _check_shard(shard_index, shard_count):
+    if shard_index is None and shard_count is None:
+        return
+    if shard_index is None or shard_count is None:
+        raise ValueError('shard_index and shard_count must be used together!')
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f'shard_index must be between 0 and {shard_count - 1}, '
+            f'got {shard_index}'
+        )
+
+
+def _in_shard(quad, shard_index, shard_count):
+    """
+    Deterministically assign a quad to a shard based on its mosaic and id.
+    Uses crc32 rather than ``hash`` so that every process agrees.
+    """
+    if shard_count is None:
+        return True
+    key = f'{quad.mosaic_name}/{quad.id}'.encode('utf-8')
+    return zlib.crc32(key) % shard_count == shard_index
+
+
+def _download_all(quads, download, nthreads, client, queue=None,
+                  shard_index=None, shard_count=None):
+    """
+    Shared download loop for ``Mosaic`` and ``MosaicSeries``. Quads are either
+    filtered to a single shard or pushed through a shared ``QuadQueue``.
+    """
+    _check_shard(shard_index, shard_count)
+    quads = (q for q in quads if _in_shard(q, shard_index, shard_count))
+
+    if queue is not None:
+        from download_queue import QuadQueue
+        if not isinstance(queue, QuadQueue):
+            queue = QuadQueue(queue)
+        queue.populate(quads)
+        for path in queue.work(download, nthreads, client, quads=quads):
+            yield path
+        return
+
+    groups = _chunks(quads, 4 * nthreads)
+    with ThreadPoolExecutor(nthreads) as executor:
+        for group in groups:
+            for path in executor.map(download, group):
+                yield path
+
 class BasemapsClient(object):
     """Demo client for working with the Planet basemaps API"""
 
     base_url = 'https://api.planet.com/basemaps/v1'
 
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, max_bandwidth=None, max_downloads=None,
+                 page_size=None, json_loads=None, catalog=None):
         """
         :param str api_key:
             Your Planet API key. If not specified, this will be read from the
             PL_API_KEY environment variable.
+        :param float max_bandwidth:
+            Cap on the combined download rate of this client in bytes per
+            second. Unlimited by default.
+        :param int max_downloads:
+            Cap on the number of simultaneous downloads across all
+            ``download_quads`` calls using this client. Unlimited by default.
+        :param int page_size:
+            Number of items to request per page when listing. Larger pages
+            mean fewer round-trips. Defaults to the server's page size.
+        :param callable json_loads:
+            Function used to decode responses. Defaults to ``orjson.loads``
+            if orjson is installed and ``json.loads`` otherwise.
+        :param str,QuadCatalog catalog:
+            A ``QuadCatalog`` (or path to one, see ``quad_catalog.py``) to
+            answer series and quad searches from when it has indexed the
+            area requested.
         """
         if api_key is None:
             api_key = os.getenv('PL_API_KEY')
@@ -115,12 +191,24 @@ class BasemapsClient(object):
         retries = Retry(total=5, backoff_factor=0.2, status_forcelist=[429])
         self.session.mount('https://', HTTPAdapter(max_retries=retries))
 
+        self.scheduler = DownloadScheduler(max_bandwidth, max_downloads)
+
+        self._page_size = page_size
+        self._loads = json_loads or _json_loads
+
+        if isinstance(catalog, str):
+            from quad_catalog import QuadCatalog
+            catalog = QuadCatalog(catalog, self)
+        self.catalog = catalog
+
     def _url(self, endpoint):
         return '{}/{}'.format(self.base_url, endpoint)
 
     def _consume_pages(self, endpoint, key, **params):
         """General pagination structure for Planet APIs."""
         url = self._url(endpoint)
+        if self._page_size is not None:
+            params.setdefault('_page_size', self._page_size)
         while True:
             response = self._get(url, **params)
             for item in response[key]:
@@ -134,11 +222,14 @@ class BasemapsClient(object):
     def _query(self, endpoint, key, json_query):
         """Post and then get for pagination. Being lazy here and repeating."""
         url = None
+        params = {}
+        if self._page_size is not None:
+            params['_page_size'] = self._page_size
 
         while True:
             if url is None:
                 url = self._url(endpoint)
-                response = self._post(url, json_query)
+                response = self._post(url, json_query, **params)
             else:
                 response = self._get(url)
 
@@ -158,40 +249,51 @@ class BasemapsClient(object):
     def _get(self, url, **params):
         rv = self.session.get(url, params=params)
         rv.raise_for_status()
-        return rv.json()
+        return self._loads(rv.content)
 
-    def _post(self, url, json_data):
-        rv = self.session.post(url, json=json_data)
+    def _post(self, url, json_data, **params):
+        rv = self.session.post(url, json=json_data, params=params)
         rv.raise_for_status()
-        return rv.json()
+        return self._loads(rv.content)
 
     def _item(self, endpoint, **params):
         return self._get(self._url(endpoint), **params)
 
-    def _download(self, url, filename=None, output_dir=None):
-        response = self.session.get(url, stream=True)
-        response.raise_for_status()
-
-        disposition = response.headers['Content-Disposition']
-        if filename is None:
-            filename = re.findall(r'filename="(.+)"', disposition)[0]
-
-        if filename is None:
-            msg = 'Filename not specified and no content-disposition info!'
-            raise ValueError(msg)
-
-        if output_dir is not None:
-            try:
-                os.mkdir(output_dir)
-            except OSError:
-                # Due to threading, the directory may be created simultaneously
-                pass
-            filename = os.path.join(output_dir, filename)
-
-        # Download in chunks.
-        with open(filename, 'wb') as outfile:
-            shutil.copyfileobj(response.raw, outfile)
-        del response
+    def _download(self, url, filename=None, output_dir=None,
+                  priority=PRIORITY_NORMAL, group=None, chunksize=65536):
+        with self.scheduler.slot(priority, group) as transfer:
+            response = self.session.get(url, stream=True)
+            response.raise_for_status()
+
+            length = response.headers.get('Content-Length')
+            if length is not None:
+                transfer.expected = int(length)
+
+            disposition = response.headers['Content-Disposition']
+            if filename is None:
+                filename = re.findall(r'filename="(.+)"', disposition)[0]
+
+            if filename is None:
+                msg = 'Filename not specified and no content-disposition info!'
+                raise ValueError(msg)
+
+            if output_dir is not None:
+                try:
+                    os.mkdir(output_dir)
+                except OSError:
+                    # Due to threading, the directory may be created simultaneously
+                    pass
+                filename = os.path.join(output_dir, filename)
+
+            # Download in chunks, pausing as needed to respect bandwidth limits.
+            with open(filename, 'wb') as outfile:
+                while True:
+                    chunk = response.raw.read(chunksize)
+                    if not chunk:
+                        break
+                    self.scheduler.throttle(transfer, len(chunk))
+                    outfile.write(chunk)
+            del response
 
         return filename
 
@@ -309,6 +411,13 @@ class MosaicSeries(object):
             The earliest date to use. Note that this check is based on the
             last_acquired metadata for the mosaic.
         """
+        catalog = self.client.catalog
+        if catalog is not None and catalog.has_series(self.id, start_date,
+                                                      end_date):
+            return catalog.mosaics(self.id, start_date, end_date)
+        return self._list_mosaics(start_date, end_date)
+
+    def _list_mosaics(self, start_date=None, end_date=None):
         params = {}
         if start_date is not None:
             params['acquired__gt'] = str(start_date)
@@ -322,7 +431,9 @@ class MosaicSeries(object):
 
     def download_quads(self, region=None, bbox=None, start_date=None,
                        end_date=None, nthreads=16, flat=False,
-                       filename_template=None):
+                       filename_template=None, shard_index=None,
+                       shard_count=None, queue=None,
+                       priority=PRIORITY_NORMAL):
         """
         Download quads for all mosaics in the series. Will be downloaded into
         separate folders based on mosaic names.
@@ -347,13 +458,28 @@ class MosaicSeries(object):
             A {} style format string with the keys "mosaic", "level", "x", "y".
             Defaults to the Content-Deposition sepecified by the API. (i.e.
             typically "L{z}-{x}E-{y}N.tif")
+        :param int shard_index:
+            Only download quads belonging to this shard (0-based). Must be
+            used together with ``shard_count``. Each process enumerates the
+            quads itself, but only fetches its own share.
+        :param int shard_count:
+            Total number of shards the download is split into.
+        :param str,QuadQueue queue:
+            A ``QuadQueue`` (or path to one, see ``download_queue.py``) shared
+            between workers. The first worker to reach the queue enumerates
+            the quads; every worker then claims quads from it until none are
+            left.
+        :param int priority:
+            Scheduling priority relative to other downloads made with the same
+            client, e.g. ``PRIORITY_INTERACTIVE`` or ``PRIORITY_BACKFILL``.
+            Lower values are served first.
         """
         if flat and not filename_template:
             filename_template = '{mosaic}-L{level}-{x:04d}E-{y:04d}N.tif'
 
         def all_quads():
             for mosaic in self.mosaics(start_date, end_date):
-                for quad in mosaic.quads(bbox, region):
+                for quad in mosaic.quads(bbox, region, lean=True):
                     if quad.downloadable:
                         yield quad
 
@@ -367,13 +493,13 @@ class MosaicSeries(object):
                                                     level=quad.level,
                                                     x=quad.x,
                                                     y=quad.y)
-            return quad.download(filename=filename, output_dir=output_dir)
+            return quad.download(filename=filename, output_dir=output_dir,
+                                 priority=priority, group=group)
 
-        groups = _chunks(all_quads(), 4 * nthreads)
-        with ThreadPoolExecutor(nthreads) as executor:
-            for group in groups:
-                for path in executor.map(download, group):
-                    yield path
+        # Identifies this call to the scheduler so concurrent calls share fairly
+        group = object()
+        return _download_all(all_quads(), download, nthreads, self.client,
+                             queue, shard_index, shard_count)
 
 
 class Mosaic(object):
@@ -422,7 +548,7 @@ class Mosaic(object):
         endpoint = f'mosaics/{self.id}/quads/search'
         return self.client._query(endpoint, 'items', region)
 
-    def quads(self, bbox=None, region=None):
+    def quads(self, bbox=None, region=None, lean=False):
         """
         Retrieve info for all quads within a specific AOI specified as either a
         lon/lat ``bbox`` or a geojson ``region``.
@@ -433,17 +559,34 @@ class Mosaic(object):
         :param dict region:
             A GeoJSON geometry (usually polygon or multipolygon, not a feature
             collection) in WGS84 representing the exact AOI.
+        :param bool lean:
+            Yield compact ``QuadRecord`` instances holding only the id,
+            bounds, coverage and download link instead of full
+            ``MosaicQuad`` objects. Much cheaper when listing many quads.
         """
-        if region:
-            quads = self._region_search(region)
-        else:
-            quads = self._bbox_search(bbox)
+        quads = None
+        if self.client.catalog is not None:
+            # None unless the catalog has indexed this AOI
+            quads = self.client.catalog.quad_items(self, bbox, region)
+
+        if quads is None:
+            if region:
+                quads = self._region_search(region)
+            else:
+                quads = self._bbox_search(bbox)
 
-        for info in quads:
-            yield MosaicQuad(info, self, self.client)
+        if lean:
+            for info in quads:
+                yield QuadRecord.from_item(info, self.name, self.level,
+                                           self.client)
+        else:
+            for info in quads:
+                yield MosaicQuad(info, self, self.client)
 
     def download_quads(self, output_dir=None, bbox=None, region=None,
-                       nthreads=16, filename_template=None):
+                       nthreads=16, filename_template=None,
+                       shard_index=None, shard_count=None, queue=None,
+                       priority=PRIORITY_NORMAL):
         """
         Download mosaic data to a local directory for a specific AOI specified
         as either a lon/lat ``bbox`` or a geojson ``region``.
@@ -460,6 +603,19 @@ class Mosaic(object):
             A {} style format string with the keys "mosaic", "level", "x", "y".
             Defaults to the Content-Deposition sepecified by the API. (i.e.
             typically "L{z}-{x}E-{y}N.tif")
+        :param int shard_index:
+            Only download quads belonging to this shard (0-based). Must be
+            used together with ``shard_count``.
+        :param int shard_count:
+            Total number of shards the download is split into.
+        :param str,QuadQueue queue:
+            A ``QuadQueue`` (or path to one, see ``download_queue.py``) shared
+            between workers. The quad search is only run by the first worker
+            to reach the queue.
+        :param int priority:
+            Scheduling priority relative to other downloads made with the same
+            client, e.g. ``PRIORITY_INTERACTIVE`` or ``PRIORITY_BACKFILL``.
+            Lower values are served first.
         """
 
         def download(quad):
@@ -471,14 +627,44 @@ class Mosaic(object):
             else:
                 filename = None
 
-            quad.download(filename=filename, output_dir=output_dir)
+            return quad.download(filename=filename, output_dir=output_dir,
+                                 priority=priority, group=group)
+
+        quads = self.quads(bbox, region, lean=True)
+        # Identifies this call to the scheduler so concurrent calls share fairly
+        group = object()
+        return _download_all(quads, download, nthreads, self.client,
+                             queue, shard_index, shard_count)
 
-        quads = self.quads(bbox, region)
-        groups = _chunks(quads, 4 * nthreads)
-        with ThreadPoolExecutor(nthreads) as executor:
-            for group in groups:
-                for path in executor.map(download, group):
-                    yield path
+    def zonal_stats(self, features, bands=None, stats=('count', 'mean'),
+                    bins=None, processes=None):
+        """
+        Per-polygon statistics for many polygons. Polygons are grouped by the
+        quads they intersect, so each quad is streamed once (reading only the
+        window covering its polygons) no matter how many polygons it holds.
+        Quads are reduced in a process pool. Requires numpy and rasterio.
+
+        :param list features:
+            GeoJSON features or geometries in WGS84. Feature ids are used in
+            the output if present.
+        :param list bands:
+            1-based band indexes. Defaults to every band except alpha.
+        :param list stats:
+            Any of "count", "mean", "std", "min", "max", "median",
+            "histogram" or percentiles such as "p10" or "p95".
+        :param bins:
+            Bins for "histogram" (as accepted by ``numpy.histogram``).
+            Defaults to 64 bins over the mosaic's nominal value range.
+        :param int processes:
+            Number of worker processes. Defaults to the number of CPUs.
+
+        :returns dict:
+            A columnar table: "id", "quads" (number of quads each polygon
+            touches) and a "b{band}_{stat}" column per band and statistic.
+            Pass it to ``pandas.DataFrame`` for a data frame.
+        """
+        from zonal_stats import zonal_stats
+        return zonal_stats(self, features, bands, stats, bins, processes)
 
     @property
     def nbands(self):
@@ -594,18 +780,72 @@ class MosaicQuad(object):
         """URL to download or stream COG data."""
         return self.links.get('download')
 
-    def download(self, filename=None, output_dir=None):
-        """Download quad data locally."""
+    def download(self, filename=None, output_dir=None,
+                 priority=PRIORITY_NORMAL, group=None):
+        """
+        Download quad data locally. See ``DownloadScheduler`` for the meaning
+        of ``priority`` and ``group``.
+        """
         if self.download_url:
-            return self.client._download(self.download_url, filename, output_dir)
+            return self.client._download(self.download_url, filename,
+                                         output_dir, priority, group)
 
     def contribution(self):
         """
         Planet data api URLs for each scene that contributed to this quad.
         """
+        catalog = self.client.catalog
+        if catalog is not None:
+            scenes = catalog.contribution(self.mosaic.id, self.id)
+            if scenes is not None:
+                return scenes
+
         url = self.links.get('items')
         if url:
             data = self.client._get(url)
             return [item['link'] for item in data['items']]
         else:
             return []
+
+
+class QuadRecord(object):
+    """
+    A compact representation of a quad with only the fields needed to find
+    and download it. See ``Mosaic.quads(lean=True)``.
+    """
+
+    __slots__ = ('client', 'id', 'mosaic_name', 'level', 'download_url',
+                 'bounds', 'coverage', 'x', 'y')
+
+    def __init__(self, quad_id, mosaic_name, level, download_url,
+                 bounds=None, coverage=None, client=None):
+        self.client = _get_client(client)
+        self.id = quad_id
+        self.mosaic_name = mosaic_name
+        self.level = level
+        self.download_url = download_url
+        self.bounds = bounds
+        self.coverage = coverage
+
+        x, y = quad_id.split('-')
+        self.x = int(x)
+        self.y = int(y)
+
+    @classmethod
+    def from_item(cls, item, mosaic_name, level, client=None):
+        """Build a record from a quad item in an API response."""
+        links = item.get('_links', {})
+        return cls(item['id'], mosaic_name, level, links.get('download'),
+                   item.get('bbox'), item.get('percent_covered'), client)
+
+    @property
+    def downloadable(self):
+        """Whether or not you have download permissions for the quad."""
+        return self.download_url is not None
+
+    def download(self, filename=None, output_dir=None,
+                 priority=PRIORITY_NORMAL, group=None):
+        """Download quad data locally."""
+        if self.download_url:
+            return self.client._download(self.download_url, filename,
+                                         output_dir, priority, group)
@@ -0,0 +1,125 @@
+"""
+Benchmark quad listing throughput (items/second) for each combination of
+page size, JSON decoder and parsing path (``MosaicQuad`` vs ``QuadRecord``).
+
+By default this runs offline against synthetic pages with a simulated
+per-request latency, which isolates round-trip and parsing costs. Use
+``--mosaic`` to list real quads instead (requires PL_API_KEY).
+
+    python bench_pagination.py --items 20000 --latency 0.1
+    python bench_pagination.py --mosaic global_monthly_2021_02_mosaic \\
+        --bbox -88 34 -86 36
+"""
+import json
+import time
+import argparse
+import itertools as it
+
+from basemaps_client import BasemapsClient, Mosaic, orjson
+
+
+MOSAIC_INFO = {
+    'id': 'bench-mosaic',
+    'name': 'bench_mosaic',
+    'level': 15,
+    'item_types': ['PSScene'],
+    'datatype': 'uint16',
+    'first_acquired': '2021-02-01T00:00:00.000Z',
+    'last_acquired': '2021-03-01T00:00:00.000Z',
+    'bbox': [-180, -85, 180, 85],
+}
+
+
+def _fake_item(i):
+    quad_id = f'{i % 4096:04d}-{i // 4096:04d}'
+    base = f'https://api.planet.com/basemaps/v1/mosaics/bench-mosaic/quads/{quad_id}'
+    return {
+        '_links': {
+            '_self': base,
+            'download': f'https://link.planet.com/basemaps/v1/mosaics/bench-mosaic/quads/{quad_id}/full?api_key=XXXX',
+            'items': f'{base}/items',
+            'thumbnail': f'https://tiles.planet.com/basemaps/v1/planet-tiles/bench_mosaic/thumbs/{quad_id}.png',
+        },
+        'bbox': [-87.1 + i * 1e-3, 35.0, -87.0 + i * 1e-3, 35.1],
+        'id': quad_id,
+        'percent_covered': 100,
+    }
+
+
+class _FakeResponse(object):
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+
+class _FakeSession(object):
+    """Serves pre-serialized pages of synthetic quads with a fixed latency."""
+
+    def __init__(self, total, page_size, latency):
+        self.latency = latency
+        self.pages = []
+        starts = range(0, total, page_size)
+        for page, start in enumerate(starts):
+            items = [_fake_item(i)
+                     for i in range(start, min(start + page_size, total))]
+            links = {}
+            if page + 1 < len(starts):
+                links['_next'] = f'https://bench/quads?page={page + 1}'
+            content = json.dumps({'items': items, '_links': links})
+            self.pages.append(content.encode('utf-8'))
+
+    def get(self, url, params=None):
+        time.sleep(self.latency)
+        page = int(url.split('page=')[1]) if 'page=' in url else 0
+        return _FakeResponse(self.pages[page])
+
+
+def _run(mosaic, lean, bbox=None):
+    start = time.perf_counter()
+    count = 0
+    for quad in mosaic.quads(bbox=bbox, lean=lean):
+        # Touch the fields callers actually use
+        quad.id, quad.bounds, quad.coverage, quad.download_url
+        count += 1
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='Simulated seconds per request (offline only)')
+    parser.add_argument('--page-sizes', type=int, nargs='+',
+                        default=[50, 250, 1000])
+    parser.add_argument('--mosaic', help='Benchmark a real mosaic instead')
+    parser.add_argument('--bbox', type=float, nargs=4)
+    args = parser.parse_args()
+
+    decoders = [('json', json.loads)]
+    if orjson is not None:
+        decoders.append(('orjson', orjson.loads))
+
+    print(f'{"page size":>9} {"decoder":>8} {"parser":>7} '
+          f'{"items":>7} {"seconds":>8} {"items/s":>9}')
+    combos = it.product(args.page_sizes, decoders, [False, True])
+    for page_size, (decoder, loads), lean in combos:
+        # Live runs read the key from PL_API_KEY
+        api_key = None if args.mosaic else 'bench'
+        client = BasemapsClient(api_key=api_key, page_size=page_size,
+                                json_loads=loads)
+        if args.mosaic:
+            mosaic = client.mosaic(name=args.mosaic)
+        else:
+            client.session = _FakeSession(args.items, page_size, args.latency)
+            mosaic = Mosaic(dict(MOSAIC_INFO), client)
+
+        count, elapsed = _run(mosaic, lean, args.bbox)
+        parser_name = 'lean' if lean else 'full'
+        print(f'{page_size:>9} {decoder:>8} {parser_name:>7} '
+              f'{count:>7} {elapsed:>8.2f} {count / elapsed:>9.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+"""
+A sqlite-backed work queue that lets many worker processes (or machines
+sharing a filesystem) split a quad download without fetching any quad twice.
+See the ``queue`` argument of ``Mosaic.download_quads``.
+"""
+import os
+import time
+import socket
+import sqlite3
+import contextlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from basemaps_client import QuadRecord, _chunks
+
+
+class QueuedQuad(QuadRecord):
+    """
+    A quad claimed from a ``QuadQueue``. Carries just enough information to
+    download the quad without re-querying the API.
+    """
+
+    __slots__ = ('key',)
+
+    def __init__(self, key, mosaic_name, quad_id, level, download_url,
+                 client=None):
+        super().__init__(quad_id, mosaic_name, level, download_url,
+                         client=client)
+        self.key = key
+
+
+class QuadQueue(object):
+    """
+    A work queue of quads stored in a sqlite database, so that many worker
+    processes (or machines sharing a filesystem) can split a download without
+    fetching any quad twice.
+
+    Workers lease quads for ``lease_timeout`` seconds. If a worker dies, its
+    leases expire and the quads are handed out to the next worker that asks.
+    Enumerating the quads is leased the same way: the enumerating worker
+    renews its lease after every batch it adds, and if it dies another
+    worker takes over once the lease expires.
+    Note that the filesystem holding the database must support POSIX file
+    locks for sqlite to be safe across machines.
+    """
+
+    def __init__(self, path, lease_timeout=600, max_attempts=3, worker=None):
+        """
+        :param str path:
+            Path to the sqlite database. Created if it does not exist.
+        :param float lease_timeout:
+            Seconds a claimed quad (or the enumeration) stays reserved for a
+            worker before it is handed to another one.
+        :param int max_attempts:
+            Number of times a quad is handed out before it is marked failed.
+        :param str worker:
+            Name of this worker. Defaults to "<hostname>-<pid>".
+        """
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        if worker is None:
+            worker = f'{socket.gethostname()}-{os.getpid()}'
+        self.worker = worker
+
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS quads (
+                key TEXT PRIMARY KEY,
+                mosaic_name TEXT,
+                quad_id TEXT,
+                level INTEGER,
+                download_url TEXT,
+                state TEXT DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER DEFAULT 0,
+                path TEXT
+            );
+            CREATE INDEX IF NOT EXISTS quads_state ON quads (state);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        An explicit write transaction. The connection is in autocommit mode
+        (``isolation_level=None``), so ``with self._conn`` would not start
+        one and every statement would commit on its own.
+        """
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def _set_meta(self, key, value):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, value),
+        )
+
+    def _get_meta(self, key):
+        row = self._conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    @property
+    def enumerated(self):
+        """Whether all quads have been added to the queue."""
+        return self._get_meta('enumerated') == 'done'
+
+    def _lease_enumeration(self):
+        """
+        Take or renew the enumeration lease. Returns False if enumeration is
+        finished or another worker holds a live lease. Must be called within
+        a transaction.
+        """
+        if self.enumerated:
+            return False
+        now = time.time()
+        owner = self._get_meta('enumerator')
+        expires = float(self._get_meta('enumeration_expires') or 0)
+        if owner not in (None, self.worker) and expires > now:
+            return False
+        self._set_meta('enumerator', self.worker)
+        self._set_meta('enumeration_expires', str(now + self.lease_timeout))
+        return True
+
+    def populate(self, quads, batchsize=500):
+        """
+        Add quads to the queue. Only the worker holding the enumeration lease
+        iterates through ``quads``; everyone else returns immediately, so the
+        (potentially slow) quad search normally runs once. Quads are
+        committed batch by batch, so other workers can start downloading
+        straight away, and if this worker dies part way through, the next
+        worker to take over the lease only adds the quads that are missing.
+
+        :param iterable quads:
+            ``MosaicQuad`` instances. Quads without download permissions are
+            skipped.
+        :returns int:
+            Number of quads added by this call.
+        """
+        with self._transaction():
+            if not self._lease_enumeration():
+                return 0
+
+        count = 0
+        rows = ((f'{q.mosaic_name}/{q.id}', q.mosaic_name, q.id, q.level,
+                 q.download_url) for q in quads if q.downloadable)
+        try:
+            for group in _chunks(rows, batchsize):
+                with self._transaction():
+                    self._conn.executemany(
+                        'INSERT OR IGNORE INTO quads (key, mosaic_name, '
+                        'quad_id, level, download_url) VALUES (?, ?, ?, ?, ?)',
+                        group,
+                    )
+                    # Heartbeat. Stop if another worker has taken over.
+                    leased = self._lease_enumeration()
+                count += len(group)
+                if not leased:
+                    return count
+        except BaseException:
+            # Let another worker take over without waiting for the lease
+            with self._transaction():
+                if self._get_meta('enumerator') == self.worker:
+                    self._set_meta('enumeration_expires', '0')
+            raise
+
+        with self._transaction():
+            self._set_meta('enumerated', 'done')
+        return count
+
+    def claim(self, n=1, client=None):
+        """
+        Lease up to ``n`` pending quads for this worker. Expired leases are
+        returned to the queue first, or marked failed once the quad has been
+        handed out ``max_attempts`` times.
+
+        :returns list:
+            ``QueuedQuad`` instances. Empty if nothing is currently pending.
+        """
+        now = time.time()
+        with self._transaction():
+            # A quad that keeps killing its worker must not loop forever
+            self._conn.execute(
+                "UPDATE quads SET worker = NULL, lease_expires = NULL, "
+                "state = CASE WHEN attempts >= ? THEN 'failed' "
+                "ELSE 'pending' END "
+                "WHERE state = 'leased' AND lease_expires < ?",
+                (self.max_attempts, now),
+            )
+            rows = self._conn.execute(
+                "SELECT key, mosaic_name, quad_id, level, download_url "
+                "FROM quads WHERE state = 'pending' ORDER BY rowid LIMIT ?",
+                (n,),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE quads SET state = 'leased', worker = ?, "
+                "lease_expires = ?, attempts = attempts + 1 WHERE key = ?",
+                [(self.worker, now + self.lease_timeout, row[0])
+                 for row in rows],
+            )
+
+        return [QueuedQuad(*row, client=client) for row in rows]
+
+    def _finish(self, completed=(), released=(), renewed=()):
+        """
+        Record the outcome of claimed quads in a single transaction.
+        ``completed`` holds (quad, path) pairs and the leases of the quads in
+        ``renewed`` (still downloading) are extended. Quads whose lease has
+        been taken over by another worker are left alone, apart from
+        completed quads that nobody else has finished yet.
+        """
+        with self._transaction():
+            self._conn.executemany(
+                "UPDATE quads SET state = 'done', path = ?, worker = NULL "
+                "WHERE key = ? AND state != 'done' AND "
+                "(worker = ? OR worker IS NULL)",
+                [(path, quad.key, self.worker) for quad, path in completed],
+            )
+            self._conn.executemany(
+                "UPDATE quads SET worker = NULL, lease_expires = NULL, "
+                "state = CASE WHEN attempts >= ? THEN 'failed' "
+                "ELSE 'pending' END WHERE key = ? AND worker = ?",
+                [(self.max_attempts, quad.key, self.worker)
+                 for quad in released],
+            )
+            self._conn.executemany(
+                "UPDATE quads SET lease_expires = ? WHERE key = ? AND "
+                "worker = ? AND state = 'leased'",
+                [(time.time() + self.lease_timeout, quad.key, self.worker)
+                 for quad in renewed],
+            )
+
+    def complete(self, quad, path):
+        """Mark a claimed quad as downloaded to ``path``."""
+        self._finish(completed=[(quad, path)])
+
+    def release(self, quad):
+        """
+        Return a claimed quad to the queue after a failed download, or mark it
+        failed once it has been attempted ``max_attempts`` times.
+        """
+        self._finish(released=[quad])
+
+    def counts(self):
+        """Number of quads in each state (pending, leased, done, failed)."""
+        rows = self._conn.execute(
+            'SELECT state, COUNT(*) FROM quads GROUP BY state'
+        )
+        return dict(rows.fetchall())
+
+    def work(self, download, nthreads=16, client=None, poll_interval=5,
+             quads=None):
+        """
+        Claim and download quads until the queue is exhausted. Yields the
+        output path of each quad this worker downloaded.
+
+        Quads are only claimed as download threads become free, and the
+        leases of quads still downloading are renewed whenever a download
+        finishes (and at least every third of ``lease_timeout``), so slow or
+        throttled downloads are not handed out to a second worker. If a
+        download fails, no more quads are claimed and the error is raised
+        once the downloads in flight have finished.
+
+        :param callable download:
+            Called with each ``QueuedQuad``; should return the output path.
+        :param int nthreads:
+            Number of concurrent downloads within this worker.
+        :param float poll_interval:
+            Seconds to wait before checking again when the queue is empty but
+            another worker is still enumerating quads or holds leases that
+            may expire.
+        :param iterable quads:
+            The quads passed to ``populate``. If given, this worker takes
+            over enumeration when the enumerating worker's lease expires.
+        """
+        in_flight, error = {}, None
+        with ThreadPoolExecutor(nthreads) as executor:
+            while True:
+                if error is None and len(in_flight) < nthreads:
+                    claimed = self.claim(nthreads - len(in_flight), client)
+                    for quad in claimed:
+                        in_flight[executor.submit(download, quad)] = quad
+
+                if not in_flight:
+                    if error is not None:
+                        raise error
+                    if quads is not None and self.populate(quads):
+                        continue
+                    counts = self.counts()
+                    if self.enumerated and not counts.get('leased'):
+                        return
+                    time.sleep(poll_interval)
+                    continue
+
+                done, _ = wait(in_flight, timeout=self.lease_timeout / 3,
+                               return_when=FIRST_COMPLETED)
+                completed, released = [], []
+                for future in done:
+                    quad = in_flight.pop(future)
+                    try:
+                        completed.append((quad, future.result()))
+                    except Exception as err:
+                        released.append(quad)
+                        error = error or err
+
+                # Outcomes and the heartbeat for the rest go in one write
+                self._finish(completed, released, in_flight.values())
+                for _, path in completed:
+                    yield path
@@ -0,0 +1,202 @@
+"""
+Priority and fair-share scheduling of downloads, with an optional bandwidth
+cap, shared by every download made through a ``BasemapsClient``.
+"""
+import time
+import threading
+import contextlib
+import collections
+import itertools as it
+
+
+# Download priorities. Lower values are served first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 10
+PRIORITY_BACKFILL = 20
+
+
+class _Transfer(object):
+    """Book-keeping for a single download handled by a DownloadScheduler."""
+
+    def __init__(self, priority, group, seq, expected=None):
+        self.priority = priority
+        self.group = group
+        self.seq = seq
+        self.expected = expected
+        self.received = 0
+
+
+class DownloadScheduler(object):
+    """
+    Shares download slots and bandwidth between every download made through a
+    ``BasemapsClient``, including concurrent ``download_quads`` calls.
+
+    Waiting downloads are served in priority order. Within a priority class,
+    slots go to the group (i.e. ``download_quads`` call) with the fewest
+    active downloads and bandwidth goes to the group that has received the
+    fewest bytes, so one large backfill can't crowd out a smaller request.
+    Bandwidth is capped with a token bucket shared by all downloads.
+    """
+
+    def __init__(self, max_bandwidth=None, max_downloads=None, burst=None):
+        """
+        :param float max_bandwidth:
+            Maximum combined download rate in bytes per second. Unlimited if
+            not specified.
+        :param int max_downloads:
+            Maximum number of simultaneous downloads. Unlimited if not
+            specified.
+        :param float burst:
+            Size of the token bucket in bytes. Defaults to one second's worth
+            of ``max_bandwidth``.
+        """
+        self.max_bandwidth = max_bandwidth
+        self.max_downloads = max_downloads
+        if burst is None and max_bandwidth is not None:
+            burst = max_bandwidth
+        self.burst = burst
+
+        self._cond = threading.Condition()
+        self._seq = it.count()
+        self._tokens = burst or 0
+        self._last_refill = time.monotonic()
+        self._queued = []
+        self._throttled = []
+        self._in_flight = []
+        self._active = collections.Counter()
+        self._served = {}
+
+        self.bytes_transferred = 0
+        # Successful downloads (and their bytes, for estimating sizes)
+        self.downloads_completed = 0
+        self._completed_bytes = 0
+        self.downloads_failed = 0
+
+    def _slot_key(self, transfer):
+        return transfer.priority, self._active[transfer.group], transfer.seq
+
+    def _byte_key(self, transfer):
+        return transfer.priority, self._served[transfer.group], transfer.seq
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.burst,
+                           self._tokens + elapsed * self.max_bandwidth)
+
+    @contextlib.contextmanager
+    def slot(self, priority=PRIORITY_NORMAL, group=None, size=None):
+        """
+        Context manager that blocks until a download slot is free for this
+        priority and group. Yields a handle to pass to ``throttle``. The
+        download counts as failed if the block raises.
+
+        :param int size:
+            Expected size of the download in bytes, if known. Only used for
+            ``stats``; set ``expected`` on the handle once it is known.
+        """
+        transfer = _Transfer(priority, group, next(self._seq), size)
+        with self._cond:
+            self._queued.append(transfer)
+            while True:
+                full = (self.max_downloads is not None and
+                        len(self._in_flight) >= self.max_downloads)
+                if not full and min(self._queued, key=self._slot_key) is transfer:
+                    break
+                self._cond.wait()
+
+            self._queued.remove(transfer)
+            self._in_flight.append(transfer)
+            if not self._active[group]:
+                # A group joining (or re-joining) starts level with the
+                # least-served active group rather than at zero.
+                active = [self._served[g] for g in self._active if self._active[g]]
+                self._served[group] = min(active, default=0)
+            self._active[group] += 1
+            self._cond.notify_all()
+
+        failed = True
+        try:
+            yield transfer
+            failed = False
+        finally:
+            with self._cond:
+                self._in_flight.remove(transfer)
+                self._active[group] -= 1
+                if not self._active[group]:
+                    del self._active[group]
+                    del self._served[group]
+                if failed:
+                    self.downloads_failed += 1
+                else:
+                    self.downloads_completed += 1
+                    self._completed_bytes += transfer.received
+                self._cond.notify_all()
+
+    def throttle(self, transfer, nbytes):
+        """
+        Account for ``nbytes`` received by ``transfer``, blocking as needed to
+        stay under ``max_bandwidth``.
+        """
+        with self._cond:
+            if self.max_bandwidth is not None:
+                self._throttled.append(transfer)
+                while True:
+                    if min(self._throttled, key=self._byte_key) is transfer:
+                        self._refill()
+                        needed = min(nbytes, self.burst)
+                        if self._tokens >= needed:
+                            break
+                        deficit = needed - self._tokens
+                        self._cond.wait(deficit / self.max_bandwidth)
+                    else:
+                        self._cond.wait()
+
+                self._throttled.remove(transfer)
+                # Chunks larger than the bucket are allowed to go into debt.
+                self._tokens -= nbytes
+
+            transfer.received += nbytes
+            self._served[transfer.group] += nbytes
+            self.bytes_transferred += nbytes
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        A snapshot of the scheduler's state.
+
+        :returns dict:
+            ``queued`` downloads waiting for a slot (and their counts per
+            priority in ``queued_by_priority``), ``queued_bytes`` expected
+            from them, ``in_flight`` downloads, ``in_flight_bytes`` still
+            expected from them, plus running totals of ``bytes_transferred``,
+            ``downloads_completed`` (successful) and ``downloads_failed``.
+
+            Quad sizes aren't known before they are requested, so byte counts
+            use the size passed to ``slot`` or the Content-Length once
+            available, and otherwise the mean size of the downloads completed
+            so far (or nothing, before the first one completes).
+        """
+        with self._cond:
+            mean = 0
+            if self.downloads_completed:
+                mean = self._completed_bytes / self.downloads_completed
+
+            def expected(transfer):
+                if transfer.expected is not None:
+                    return transfer.expected
+                return max(mean, transfer.received)
+
+            by_priority = collections.Counter(t.priority for t in self._queued)
+            return {
+                'queued': len(self._queued),
+                'queued_by_priority': dict(by_priority),
+                'queued_bytes': int(sum(expected(t) for t in self._queued)),
+                'in_flight': len(self._in_flight),
+                'in_flight_bytes': int(sum(expected(t) - t.received
+                                           for t in self._in_flight)),
+                'bytes_transferred': self.bytes_transferred,
+                'downloads_completed': self.downloads_completed,
+                'downloads_failed': self.downloads_failed,
+            }
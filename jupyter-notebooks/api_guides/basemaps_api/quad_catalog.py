@@ -0,0 +1,509 @@
+"""
+An offline catalog of basemap series, mosaics and quads in sqlite, with an
+R-tree index on quad bounds. See the ``catalog`` argument of
+``BasemapsClient``.
+"""
+import json
+import sqlite3
+import hashlib
+import datetime as dt
+
+try:
+    from shapely.geometry import box, shape
+except ImportError:
+    shape = None
+
+from basemaps_client import (Mosaic, MosaicQuad, QuadRecord, _chunks,
+                             _get_client)
+
+
+def _geojson_bounds(geometry):
+    """Lon/lat bounds of a GeoJSON geometry."""
+    def points(coords):
+        if isinstance(coords[0], (int, float)):
+            yield coords
+        else:
+            for item in coords:
+                yield from points(item)
+
+    xs, ys = zip(*((p[0], p[1]) for p in points(geometry['coordinates'])))
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _region_key(region):
+    """A stable key for a GeoJSON geometry, to recognize repeated regions."""
+    text = json.dumps(region, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _date_string(value):
+    """
+    Normalize a date or datetime (or ISO 8601 string) to the naive UTC
+    isoformat used for mosaic dates, so that dates compare as strings.
+    """
+    if isinstance(value, str):
+        try:
+            value = dt.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return value
+    if not isinstance(value, dt.datetime):
+        value = dt.datetime.combine(value, dt.time())
+    if value.tzinfo is not None:
+        value = value.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return value.isoformat()
+
+
+def _item(quad_id, minx, miny, maxx, maxy, coverage, links):
+    """An API-style quad item from a catalog row."""
+    return {
+        'id': quad_id,
+        'bbox': [minx, miny, maxx, maxy],
+        'percent_covered': coverage,
+        '_links': json.loads(links),
+    }
+
+
+class QuadCatalog(object):
+    """
+    A local sqlite catalog of series, mosaics, quads and (optionally)
+    contributing scenes, with an R-tree index on quad bounds.
+
+    Populate it incrementally with ``add_series`` and ``add_mosaic``, then
+    ``search`` it offline, or attach it to a client (``BasemapsClient(...,
+    catalog=path)``) so that ``MosaicSeries.mosaics``, ``Mosaic.quads`` and
+    everything built on them (downloads, zonal stats, etc) use the catalog
+    instead of the API for areas it has indexed.
+
+    A region indexed with ``add_mosaic`` answers later queries for the same
+    region. Other region queries are only answered from bbox-indexed areas
+    when shapely is installed to filter quads against the region.
+    """
+
+    def __init__(self, path, client=None):
+        """
+        :param str path:
+            Path to the sqlite database. Created if it does not exist.
+        :param BasemapsClient client:
+            Client used to populate the catalog. Created if not specified.
+        """
+        self.path = path
+        self.client = client
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS series (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                info TEXT
+            );
+            CREATE TABLE IF NOT EXISTS series_ranges (
+                series_id TEXT,
+                start_date TEXT,
+                end_date TEXT
+            );
+            CREATE TABLE IF NOT EXISTS mosaics (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                level INTEGER,
+                start_date TEXT,
+                end_date TEXT,
+                info TEXT
+            );
+            CREATE INDEX IF NOT EXISTS mosaics_name ON mosaics (name);
+            CREATE INDEX IF NOT EXISTS mosaics_dates
+                ON mosaics (start_date, end_date);
+            CREATE TABLE IF NOT EXISTS series_mosaics (
+                series_id TEXT,
+                mosaic_id TEXT,
+                PRIMARY KEY (series_id, mosaic_id)
+            );
+            CREATE TABLE IF NOT EXISTS quads (
+                fid INTEGER PRIMARY KEY,
+                mosaic_id TEXT,
+                quad_id TEXT,
+                minx REAL, miny REAL, maxx REAL, maxy REAL,
+                coverage REAL,
+                links TEXT,
+                contributions TEXT,
+                UNIQUE (mosaic_id, quad_id)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS quad_bounds
+                USING rtree (fid, minx, maxx, miny, maxy);
+            CREATE TABLE IF NOT EXISTS indexed (
+                mosaic_id TEXT,
+                minx REAL, miny REAL, maxx REAL, maxy REAL
+            );
+            CREATE INDEX IF NOT EXISTS indexed_mosaic ON indexed (mosaic_id);
+            CREATE TABLE IF NOT EXISTS region_quads (
+                mosaic_id TEXT,
+                region_key TEXT,
+                quad_id TEXT,
+                PRIMARY KEY (mosaic_id, region_key, quad_id)
+            );
+            CREATE TABLE IF NOT EXISTS indexed_regions (
+                mosaic_id TEXT,
+                region_key TEXT,
+                PRIMARY KEY (mosaic_id, region_key)
+            );
+        """)
+
+    def _client(self):
+        if self.client is None:
+            self.client = _get_client(None)
+        return self.client
+
+    def _upsert_mosaic(self, mosaic, series_id=None):
+        info = dict(mosaic.info, _links=mosaic.links)
+        self._conn.execute(
+            'INSERT OR REPLACE INTO mosaics VALUES (?, ?, ?, ?, ?, ?)',
+            (mosaic.id, mosaic.name, mosaic.level,
+             mosaic.start_date.isoformat(), mosaic.end_date.isoformat(),
+             json.dumps(info)),
+        )
+        if series_id is not None:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO series_mosaics VALUES (?, ?)',
+                (series_id, mosaic.id),
+            )
+
+    def _upsert_quad(self, mosaic_id, item, contributions=None):
+        minx, miny, maxx, maxy = item['bbox']
+        links = json.dumps(item.get('_links', {}))
+        if contributions is not None:
+            contributions = json.dumps(contributions)
+
+        row = self._conn.execute(
+            'SELECT fid FROM quads WHERE mosaic_id = ? AND quad_id = ?',
+            (mosaic_id, item['id']),
+        ).fetchone()
+        if row is None:
+            fid = self._conn.execute(
+                'INSERT INTO quads (mosaic_id, quad_id, minx, miny, maxx, '
+                'maxy, coverage, links, contributions) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (mosaic_id, item['id'], minx, miny, maxx, maxy,
+                 item.get('percent_covered'), links, contributions),
+            ).lastrowid
+            self._conn.execute(
+                'INSERT INTO quad_bounds VALUES (?, ?, ?, ?, ?)',
+                (fid, minx, maxx, miny, maxy),
+            )
+        else:
+            self._conn.execute(
+                'UPDATE quads SET coverage = ?, links = ?, '
+                'contributions = COALESCE(?, contributions) WHERE fid = ?',
+                (item.get('percent_covered'), links, contributions, row[0]),
+            )
+
+    def covers(self, mosaic_id, bbox):
+        """
+        Whether all quads of a mosaic within a bbox have been indexed. Only
+        areas indexed by bbox count, as a region may not cover its bounds.
+        """
+        row = self._conn.execute(
+            'SELECT 1 FROM indexed WHERE mosaic_id = ? AND minx <= ? AND '
+            'miny <= ? AND maxx >= ? AND maxy >= ? LIMIT 1',
+            (mosaic_id,) + tuple(bbox),
+        ).fetchone()
+        return row is not None
+
+    def has_series(self, series_id, start_date=None, end_date=None):
+        """
+        Whether the mosaics of a series between two dates have been indexed
+        by a single ``add_series`` call. Open-ended dates are only covered by
+        an open-ended index.
+        """
+        sql = 'SELECT 1 FROM series_ranges WHERE series_id = ?'
+        args = [series_id]
+        if start_date is None:
+            sql += ' AND start_date IS NULL'
+        else:
+            sql += ' AND (start_date IS NULL OR start_date <= ?)'
+            args.append(_date_string(start_date))
+        if end_date is None:
+            sql += ' AND end_date IS NULL'
+        else:
+            sql += ' AND (end_date IS NULL OR end_date >= ?)'
+            args.append(_date_string(end_date))
+        row = self._conn.execute(sql + ' LIMIT 1', args).fetchone()
+        return row is not None
+
+    def covers_region(self, mosaic_id, region):
+        """Whether the quads of a mosaic within a region have been indexed."""
+        row = self._conn.execute(
+            'SELECT 1 FROM indexed_regions WHERE mosaic_id = ? AND '
+            'region_key = ?', (mosaic_id, _region_key(region)),
+        ).fetchone()
+        return row is not None
+
+    def quad_items(self, mosaic, bbox=None, region=None):
+        """
+        API-style quad items of a mosaic within an AOI, or None if the AOI
+        hasn't been indexed. Used by ``Mosaic.quads``.
+        """
+        if not region:
+            aoi = bbox if bbox is not None else mosaic.info['bbox']
+            if not self.covers(mosaic.id, aoi):
+                return None
+            return (item for _, _, item in
+                    self._items(aoi, mosaic_ids=[mosaic.id]))
+
+        if self.covers_region(mosaic.id, region):
+            return self._region_items(mosaic.id, _region_key(region))
+        if shape is not None and self.covers(mosaic.id,
+                                             _geojson_bounds(region)):
+            return (item for _, _, item in
+                    self._items(None, region, mosaic_ids=[mosaic.id]))
+        return None
+
+    def _region_items(self, mosaic_id, region_key):
+        """The quads recorded when a region was indexed, as API items."""
+        rows = self._conn.execute(
+            'SELECT q.quad_id, q.minx, q.miny, q.maxx, q.maxy, q.coverage, '
+            'q.links FROM region_quads r JOIN quads q ON '
+            'q.mosaic_id = r.mosaic_id AND q.quad_id = r.quad_id '
+            'WHERE r.mosaic_id = ? AND r.region_key = ? ORDER BY q.quad_id',
+            (mosaic_id, region_key),
+        ).fetchall()
+        for quad_id, minx, miny, maxx, maxy, coverage, links in rows:
+            yield _item(quad_id, minx, miny, maxx, maxy, coverage, links)
+
+    def add_mosaic(self, mosaic, bbox=None, region=None, contributions=False,
+                   refresh=False, series_id=None):
+        """
+        Index the quads of a mosaic within an AOI. Skipped if the AOI has
+        already been indexed, unless ``refresh`` is set.
+
+        :param Mosaic mosaic:
+            The mosaic to index.
+        :param tuple bbox:
+            A (longitude_min, latitude_min, longitude_max, latitude_max)
+            tuple. Defaults to the full extent of the mosaic.
+        :param dict region:
+            A GeoJSON geometry in WGS84. The quads the API finds for it are
+            recorded, so the same region can be answered exactly later.
+        :param bool contributions:
+            Also index the contributing scenes of each quad. This takes one
+            extra request per quad.
+
+        :returns int:
+            Number of quads indexed.
+        """
+        with self._conn:
+            self._upsert_mosaic(mosaic, series_id)
+
+        if region is not None:
+            key = _region_key(region)
+            if self.covers_region(mosaic.id, region):
+                if not refresh:
+                    return 0
+                with self._conn:
+                    self._conn.execute(
+                        'DELETE FROM indexed_regions WHERE mosaic_id = ? '
+                        'AND region_key = ?', (mosaic.id, key),
+                    )
+                    self._conn.execute(
+                        'DELETE FROM region_quads WHERE mosaic_id = ? '
+                        'AND region_key = ?', (mosaic.id, key),
+                    )
+            items = mosaic._region_search(region)
+        else:
+            aoi = tuple(bbox if bbox is not None else mosaic.info['bbox'])
+            if self.covers(mosaic.id, aoi) and not refresh:
+                return 0
+            items = mosaic._bbox_search(bbox)
+
+        count = 0
+        for group in _chunks(items, 500):
+            with self._conn:
+                for item in group:
+                    scenes = None
+                    if contributions:
+                        scenes = MosaicQuad(dict(item), mosaic,
+                                            mosaic.client).contribution()
+                    self._upsert_quad(mosaic.id, item, scenes)
+                if region is not None:
+                    self._conn.executemany(
+                        'INSERT OR IGNORE INTO region_quads VALUES (?, ?, ?)',
+                        [(mosaic.id, key, item['id']) for item in group],
+                    )
+            count += len(group)
+
+        with self._conn:
+            if region is not None:
+                self._conn.execute(
+                    'INSERT OR IGNORE INTO indexed_regions VALUES (?, ?)',
+                    (mosaic.id, key),
+                )
+            else:
+                self._conn.execute(
+                    'INSERT INTO indexed VALUES (?, ?, ?, ?, ?)',
+                    (mosaic.id,) + aoi,
+                )
+        return count
+
+    def add_series(self, series, bbox=None, region=None, start_date=None,
+                   end_date=None, contributions=False, refresh=False):
+        """
+        Index a series and its mosaics between the given dates. If an AOI is
+        given, the quads of each mosaic within it are indexed as well.
+        Mosaics and AOIs that are already indexed are skipped, so this can be
+        re-run cheaply to pick up new mosaics.
+
+        :param MosaicSeries series:
+            The series to index.
+        :param str,datetime start_date:
+            Only index mosaics after this date. ``MosaicSeries.mosaics``
+            only uses the catalog for date ranges within an indexed range.
+        :param str,datetime end_date:
+            Only index mosaics before this date.
+
+        :returns int:
+            Number of quads indexed.
+        """
+        info = dict(series.info, _links=series.links)
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO series VALUES (?, ?, ?)',
+                (series.id, series.name, json.dumps(info)),
+            )
+
+        count = 0
+        for mosaic in series._list_mosaics(start_date, end_date):
+            if bbox is not None or region is not None:
+                count += self.add_mosaic(mosaic, bbox, region, contributions,
+                                         refresh, series.id)
+            else:
+                with self._conn:
+                    self._upsert_mosaic(mosaic, series.id)
+
+        with self._conn:
+            # Only this date range is known to be complete
+            self._conn.execute(
+                'INSERT INTO series_ranges VALUES (?, ?, ?)',
+                (series.id,
+                 None if start_date is None else _date_string(start_date),
+                 None if end_date is None else _date_string(end_date)),
+            )
+        return count
+
+    def mosaics(self, series_id=None, start_date=None, end_date=None):
+        """
+        Iterate through indexed mosaics, optionally for one series and
+        overlapping the given dates. Yields ``Mosaic`` instances.
+        """
+        sql = 'SELECT m.info FROM mosaics m'
+        where, args = [], []
+        if series_id is not None:
+            sql += ' JOIN series_mosaics s ON s.mosaic_id = m.id'
+            where.append('s.series_id = ?')
+            args.append(series_id)
+        if start_date is not None:
+            where.append('m.end_date > ?')
+            args.append(_date_string(start_date))
+        if end_date is not None:
+            where.append('m.start_date < ?')
+            args.append(_date_string(end_date))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY m.start_date'
+
+        for (info,) in self._conn.execute(sql, args).fetchall():
+            yield Mosaic(json.loads(info), self._client())
+
+    def _items(self, bbox, region=None, mosaic_ids=None, series_id=None,
+               start_date=None, end_date=None):
+        """
+        Rows matching a search, as (mosaic name, level, API-style item).
+        Quads are matched against a region's bounds, and against the region
+        itself if shapely is installed.
+        """
+        geometry = None
+        if region is not None:
+            bbox = _geojson_bounds(region)
+            if shape is not None:
+                geometry = shape(region)
+
+        sql = (
+            'SELECT m.name, m.level, q.quad_id, q.minx, q.miny, q.maxx, '
+            'q.maxy, q.coverage, q.links FROM quad_bounds b '
+            'JOIN quads q ON q.fid = b.fid '
+            'JOIN mosaics m ON m.id = q.mosaic_id '
+            'WHERE b.minx <= ? AND b.maxx >= ? AND b.miny <= ? AND b.maxy >= ?'
+        )
+        args = [bbox[2], bbox[0], bbox[3], bbox[1]]
+        if mosaic_ids is not None:
+            mosaic_ids = list(mosaic_ids)
+            sql += ' AND m.id IN ({})'.format(','.join('?' * len(mosaic_ids)))
+            args += mosaic_ids
+        if series_id is not None:
+            sql += (' AND m.id IN (SELECT mosaic_id FROM series_mosaics '
+                    'WHERE series_id = ?)')
+            args.append(series_id)
+        if start_date is not None:
+            sql += ' AND m.end_date > ?'
+            args.append(_date_string(start_date))
+        if end_date is not None:
+            sql += ' AND m.start_date < ?'
+            args.append(_date_string(end_date))
+        sql += ' ORDER BY m.start_date, q.quad_id'
+
+        for name, level, quad_id, minx, miny, maxx, maxy, coverage, links \
+                in self._conn.execute(sql, args).fetchall():
+            # The R-tree stores 32-bit floats, so recheck the exact bounds
+            if minx > bbox[2] or maxx < bbox[0] or \
+                    miny > bbox[3] or maxy < bbox[1]:
+                continue
+            if geometry is not None and \
+                    not geometry.intersects(box(minx, miny, maxx, maxy)):
+                continue
+            yield name, level, _item(quad_id, minx, miny, maxx, maxy,
+                                     coverage, links)
+
+    def search(self, bbox=None, region=None, start_date=None, end_date=None,
+               series=None, mosaics=None):
+        """
+        Find indexed quads intersecting an AOI, optionally limited to a series,
+        specific mosaics and/or mosaics overlapping a time range. Note that a
+        ``region`` is only matched by its bounding box if shapely is not
+        installed.
+
+        :param tuple bbox:
+            A (longitude_min, latitude_min, longitude_max, latitude_max)
+            tuple.
+        :param dict region:
+            A GeoJSON geometry in WGS84.
+        :param str,datetime start_date:
+            Only mosaics ending after this date.
+        :param str,datetime end_date:
+            Only mosaics starting before this date.
+        :param MosaicSeries series:
+            Only mosaics in this series.
+        :param list mosaics:
+            Only these ``Mosaic`` instances.
+
+        :returns list:
+            ``QuadRecord`` instances, ordered by mosaic date.
+        """
+        if bbox is None and region is None:
+            bbox = (-180, -90, 180, 90)
+        series_id = series.id if series is not None else None
+        mosaic_ids = [m.id for m in mosaics] if mosaics is not None else None
+
+        client = self._client()
+        rows = self._items(bbox, region, mosaic_ids, series_id, start_date,
+                           end_date)
+        return [QuadRecord.from_item(item, name, level, client)
+                for name, level, item in rows]
+
+    def contribution(self, mosaic_id, quad_id):
+        """
+        Indexed contributing scene URLs for a quad, or None if they haven't
+        been indexed.
+        """
+        row = self._conn.execute(
+            'SELECT contributions FROM quads WHERE mosaic_id = ? AND '
+            'quad_id = ?', (mosaic_id, quad_id),
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
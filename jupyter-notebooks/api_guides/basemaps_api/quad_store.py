@@ -0,0 +1,237 @@
+"""
+A local, memory-mappable store for downloaded basemap quads.
+
+Quad GeoTIFFs are decoded once and saved as raw ``.npy`` chunks (one per
+quad) alongside a JSON index keyed by mosaic/level/x/y. Reading a chunk back
+is a zero-copy ``numpy.memmap``, so repeated analysis never pays for GeoTIFF
+decompression again.
+"""
+import os
+import re
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+
+
+# Matches the API's default "L15-1234E-5678N.tif" names as well as the
+# "{mosaic}-L{level}-{x:04d}E-{y:04d}N.tif" names used by flat downloads.
+QUAD_FILENAME = re.compile(
+    r'^(?:(?P<mosaic>.+)-)?L(?P<level>\d+)-(?P<x>\d+)E-(?P<y>\d+)N\.tif$'
+)
+
+
+def _parse_quad_filename(path, mosaic=None):
+    """
+    Work out the mosaic name, level, x, and y of a downloaded quad from its
+    filename. Falls back on the parent directory name for the mosaic, as
+    used by ``MosaicSeries.download_quads``.
+    """
+    match = QUAD_FILENAME.match(os.path.basename(path))
+    if match is None:
+        raise ValueError(f'Can not parse quad location from {path}')
+
+    mosaic = mosaic or match.group('mosaic')
+    if mosaic is None:
+        mosaic = os.path.basename(os.path.dirname(os.path.abspath(path)))
+
+    level, x, y = (int(match.group(k)) for k in ('level', 'x', 'y'))
+    return mosaic, level, x, y
+
+
+def _key(mosaic, level, x, y):
+    return f'{mosaic}/{level}/{x}/{y}'
+
+
+def _convert(path, chunk_path, compress):
+    """Decode a quad GeoTIFF and write it as a chunk. Runs in a worker."""
+    with rasterio.open(path) as src:
+        data = src.read()
+        meta = {
+            'shape': list(data.shape),
+            'dtype': data.dtype.str,
+            'crs': src.crs.to_string() if src.crs else None,
+            'transform': list(src.transform)[:6],
+            'bounds': list(src.bounds),
+            'nodata': src.nodata,
+        }
+
+    tmp = chunk_path + '.tmp'
+    with open(tmp, 'wb') as outfile:
+        if compress:
+            np.savez_compressed(outfile, data=data)
+        else:
+            np.save(outfile, data)
+    os.replace(tmp, chunk_path)
+    return meta
+
+
+class QuadStore(object):
+    """
+    A directory of ``.npy`` chunks (one per quad) plus an ``index.json``.
+
+    The layout is ``{root}/{mosaic}/L{level}/{x}-{y}.npy`` so that a series
+    of mosaics can be appended to incrementally as new months arrive.
+    """
+
+    index_name = 'index.json'
+
+    def __init__(self, root, compress=False):
+        """
+        :param str root:
+            Directory for the store. Created if it does not exist.
+        :param bool compress:
+            Store newly ingested chunks as compressed ``.npz`` files. These
+            are smaller on disk, but must be decompressed on every read
+            instead of being memory-mapped.
+        """
+        self.root = root
+        self.compress = compress
+        os.makedirs(root, exist_ok=True)
+
+        self._views = {}
+        self.failed = {}
+        self.index = {'chunks': {}}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as infile:
+                self.index = json.load(infile)
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.root, self.index_name)
+
+    def _save_index(self):
+        tmp = self._index_path + '.tmp'
+        with open(tmp, 'w') as outfile:
+            json.dump(self.index, outfile)
+        os.replace(tmp, self._index_path)
+
+    def _chunk_path(self, mosaic, level, x, y):
+        ext = 'npz' if self.compress else 'npy'
+        dirname = os.path.join(self.root, mosaic, f'L{level}')
+        os.makedirs(dirname, exist_ok=True)
+        return os.path.join(dirname, f'{x:04d}-{y:04d}.{ext}')
+
+    def __contains__(self, key):
+        return key in self.index['chunks']
+
+    def __len__(self):
+        return len(self.index['chunks'])
+
+    def ingest(self, paths, mosaic=None, processes=None, overwrite=False):
+        """
+        Convert downloaded quad GeoTIFFs into chunks in a process pool. Quads
+        already in the store are skipped unless ``overwrite`` is set, so this
+        can be re-run as new quads arrive.
+
+        :param iterable paths:
+            Quad filenames, e.g. the output of ``Mosaic.download_quads``.
+        :param str mosaic:
+            Mosaic name. Defaults to the name in the filename or, failing
+            that, the name of the directory the quad is in.
+        :param int processes:
+            Number of worker processes. Defaults to the number of CPUs.
+
+        :returns list:
+            Keys of the chunks that were added. Quads that could not be
+            converted are left out and recorded in ``self.failed`` (key to
+            source path and error) so they can be retried.
+        """
+        jobs = {}
+        for path in paths:
+            location = _parse_quad_filename(path, mosaic)
+            key = _key(*location)
+            if key in self and not overwrite:
+                continue
+            jobs[key] = (path, self._chunk_path(*location), location)
+
+        if not jobs:
+            return []
+
+        added = []
+        try:
+            with ProcessPoolExecutor(processes) as executor:
+                futures = {
+                    key: executor.submit(_convert, path, chunk_path,
+                                         self.compress)
+                    for key, (path, chunk_path, _) in jobs.items()
+                }
+                for key, future in futures.items():
+                    path, chunk_path, (name, level, x, y) = jobs[key]
+                    try:
+                        meta = future.result()
+                    except Exception as err:
+                        self.failed[key] = {'source': path, 'error': str(err)}
+                        continue
+                    meta.update(
+                        mosaic=name, level=level, x=x, y=y, source=path,
+                        path=os.path.relpath(chunk_path, self.root),
+                    )
+                    self.index['chunks'][key] = meta
+                    self.failed.pop(key, None)
+                    self._views.pop(key, None)
+                    added.append(key)
+        finally:
+            # Keep whatever was converted, even if ingestion is interrupted
+            self._save_index()
+        return added
+
+    def ingest_series(self, directory, processes=None, overwrite=False):
+        """
+        Ingest every quad under a directory laid out by
+        ``MosaicSeries.download_quads`` (one sub-directory per mosaic).
+        """
+        paths = []
+        for dirpath, _, filenames in os.walk(directory):
+            paths.extend(os.path.join(dirpath, name) for name in filenames
+                         if QUAD_FILENAME.match(name))
+        return self.ingest(sorted(paths), processes=processes,
+                           overwrite=overwrite)
+
+    def mosaics(self):
+        """Names of all mosaics in the store."""
+        return sorted({meta['mosaic'] for meta in self.index['chunks'].values()})
+
+    def keys(self, mosaic=None):
+        """Chunk keys ("mosaic/level/x/y"), optionally for a single mosaic."""
+        return [key for key, meta in self.index['chunks'].items()
+                if mosaic is None or meta['mosaic'] == mosaic]
+
+    def info(self, mosaic, level, x, y):
+        """Index metadata (shape, dtype, crs, transform, bounds) for a chunk."""
+        return self.index['chunks'][_key(mosaic, level, x, y)]
+
+    def read(self, mosaic, level, x, y):
+        """
+        A (bands, rows, cols) array for a quad. Uncompressed chunks are
+        returned as read-only memory maps and reused across calls, so slicing
+        them only touches the pages that are needed.
+        """
+        key = _key(mosaic, level, x, y)
+        if key in self._views:
+            return self._views[key]
+
+        meta = self.index['chunks'][key]
+        path = os.path.join(self.root, meta['path'])
+        if path.endswith('.npz'):
+            with np.load(path) as archive:
+                return archive['data']
+
+        view = np.load(path, mmap_mode='r')
+        self._views[key] = view
+        return view
+
+    def series(self, level, x, y, mosaics=None):
+        """
+        Stack a quad location across mosaics into a (time, bands, rows, cols)
+        array. Mosaics without data at that location are skipped.
+
+        :returns tuple:
+            (list of mosaic names, stacked array)
+        """
+        if mosaics is None:
+            mosaics = self.mosaics()
+        names = [m for m in mosaics if _key(m, level, x, y) in self]
+        arrays = [self.read(m, level, x, y) for m in names]
+        return names, np.stack(arrays) if arrays else None
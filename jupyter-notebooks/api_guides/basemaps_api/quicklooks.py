@@ -0,0 +1,285 @@
+"""
+Headless quicklooks for quality checking large numbers of basemap quads.
+
+Quads are read at thumbnail resolution (so GDAL uses the COG overviews),
+stretched between the 2nd and 98th percentiles of a random sample of valid
+pixels (the same stretch as ``visual._scale_bands``) and written directly from
+numpy arrays without matplotlib. Work is spread across a process pool and an
+``index.json`` and ``index.html`` are written alongside the images.
+
+Usage from the command line::
+
+    python quicklooks.py output_dir global_monthly_2021_02_mosaic/*.tif
+"""
+import os
+import re
+import html
+import json
+import zlib
+import struct
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+
+from quad_store import _parse_quad_filename
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Download URLs carry the API key as a query parameter
+API_KEY = re.compile(r'api_key=[^&\s\'"]+')
+
+
+def _default_bands(count):
+    """
+    Guess RGB band indexes from the band count (see ``Mosaic.nbands``).
+    Single band sources, and grey + alpha sources, are rendered as grey.
+    """
+    if count >= 5:
+        # BGRN + alpha, or 8-band + alpha
+        return [3, 2, 1]
+    if count <= 2:
+        return [1]
+    return [1, 2, 3]
+
+
+def _stretch_limits(data, valid, percentiles=(2, 98), sample_size=100000,
+                    seed=0):
+    """Percentile limits computed from a sample of the valid pixels."""
+    values = data[:, valid].ravel()
+    if values.size == 0:
+        return 0.0, 1.0
+    if values.size > sample_size:
+        rng = np.random.default_rng(seed)
+        values = rng.choice(values, sample_size, replace=False)
+    low, high = np.percentile(values, percentiles)
+    if high <= low:
+        high = low + 1
+    return float(low), float(high)
+
+
+def _to_uint8(data, low, high):
+    scaled = (data.astype(np.float32) - low) * (255.0 / (high - low))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def _write_png(filename, image):
+    """Minimal 8-bit PNG writer for (rows, cols, 1|2|3|4) arrays."""
+    rows, cols, channels = image.shape
+    # Grey, grey + alpha, RGB, RGBA
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+
+    # Each scanline starts with a filter type byte (0, no filtering)
+    raw = np.zeros((rows, cols * channels + 1), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(rows, -1)
+
+    def chunk(tag, payload):
+        crc = zlib.crc32(tag + payload) & 0xffffffff
+        return struct.pack('>I', len(payload)) + tag + payload + \
+            struct.pack('>I', crc)
+
+    header = struct.pack('>IIBBBBB', cols, rows, 8, color_type, 0, 0, 0)
+    with open(filename, 'wb') as outfile:
+        outfile.write(b'\x89PNG\r\n\x1a\n')
+        outfile.write(chunk(b'IHDR', header))
+        outfile.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        outfile.write(chunk(b'IEND', b''))
+
+
+def _write_jpeg(filename, image, quality=85):
+    if Image is None:
+        raise ImportError('Writing JPEG quicklooks requires Pillow')
+    if image.shape[2] == 1:
+        image = image[..., 0]
+    Image.fromarray(image).save(filename, quality=quality)
+
+
+def quicklook(source, filename, size=256, bands=None, sample_size=100000):
+    """
+    Render a single quicklook.
+
+    :param str source:
+        Path or URL of the quad (anything rasterio can open).
+    :param str filename:
+        Output filename. The format is chosen by the extension (.png or
+        .jpg). PNGs include an alpha channel for nodata.
+    :param int size:
+        Length of the longest side of the quicklook in pixels.
+    :param list bands:
+        1-based band indexes to use as RGB, or a single band to render as
+        grey. Guessed from the band count if not specified.
+    :param int sample_size:
+        Number of valid pixels sampled to compute the stretch.
+
+    :returns dict:
+        Index entry describing the quicklook.
+    """
+    with rasterio.open(source) as src:
+        if bands is None:
+            bands = _default_bands(src.count)
+        if len(bands) not in (1, 3):
+            raise ValueError('Quicklooks need either 1 (grey) or 3 (RGB) '
+                             f'bands, not {len(bands)}')
+        scale = size / max(src.width, src.height)
+        shape = (max(1, round(src.height * scale)),
+                 max(1, round(src.width * scale)))
+
+        # Reading at reduced resolution lets GDAL use overviews
+        data = src.read(bands, out_shape=(len(bands),) + shape,
+                        resampling=Resampling.nearest)
+        valid = src.dataset_mask(out_shape=shape,
+                                 resampling=Resampling.nearest) > 0
+
+    low, high = _stretch_limits(data, valid, sample_size=sample_size)
+    image = np.dstack(list(_to_uint8(data, low, high)))
+    image[~valid] = 0
+
+    if filename.lower().endswith(('.jpg', '.jpeg')):
+        _write_jpeg(filename, image)
+    else:
+        alpha = np.where(valid, 255, 0).astype(np.uint8)
+        _write_png(filename, np.dstack([image, alpha]))
+
+    return {
+        'source': source,
+        'quicklook': os.path.basename(filename),
+        'width': shape[1],
+        'height': shape[0],
+        'stretch': [low, high],
+        'valid_fraction': float(valid.mean()),
+    }
+
+
+def _quicklook(job, size, bands, sample_size):
+    """
+    Render one (source, filename, label) job. Only the label ends up in the
+    index, as streamed sources are download URLs that include an API key.
+    """
+    source, filename, label = job
+    try:
+        entry = quicklook(source, filename, size, bands, sample_size)
+    except Exception as err:
+        error = API_KEY.sub('api_key=...', str(err).replace(source, label))
+        return {'source': label, 'quicklook': None, 'error': error}
+    entry['source'] = label
+    return entry
+
+
+def _write_index(output_dir, entries):
+    with open(os.path.join(output_dir, 'index.json'), 'w') as outfile:
+        json.dump(entries, outfile, indent=1)
+
+    figures = []
+    for entry in entries:
+        caption = html.escape(os.path.basename(entry['source']))
+        if entry['quicklook'] is None:
+            figures.append(f'<figure><figcaption>{caption}: '
+                           f'{html.escape(entry["error"])}</figcaption></figure>')
+        else:
+            src = html.escape(entry['quicklook'])
+            figures.append(f'<figure><img src="{src}" loading="lazy">'
+                           f'<figcaption>{caption}</figcaption></figure>')
+
+    with open(os.path.join(output_dir, 'index.html'), 'w') as outfile:
+        outfile.write(
+            '<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+            '<title>Quicklooks</title><style>'
+            'body{display:flex;flex-wrap:wrap}'
+            'figure{margin:4px;font:11px sans-serif}'
+            'img{background:#ccc;display:block}'
+            '</style></head><body>\n'
+        )
+        outfile.write('\n'.join(figures))
+        outfile.write('\n</body></html>\n')
+
+
+def _render_all(jobs, output_dir, fmt, size, bands, sample_size, processes):
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [(source, os.path.join(output_dir, f'{name}.{fmt}'), label)
+            for source, name, label in jobs]
+
+    func = partial(_quicklook, size=size, bands=bands, sample_size=sample_size)
+    with ProcessPoolExecutor(processes) as executor:
+        # Quicklooks are quick, so hand them out in batches
+        chunksize = max(1, len(jobs) // (4 * (processes or os.cpu_count())))
+        entries = list(executor.map(func, jobs, chunksize=chunksize))
+
+    _write_index(output_dir, entries)
+    return entries
+
+
+def quad_quicklooks(paths, output_dir, size=256, fmt='png', bands=None,
+                    sample_size=100000, processes=None):
+    """
+    Render quicklooks for downloaded quads in a process pool.
+
+    :param iterable paths:
+        Quad filenames, e.g. the output of ``Mosaic.download_quads``.
+    :param str output_dir:
+        Directory for the quicklooks and index files.
+    :param str fmt:
+        "png" or "jpg".
+
+    :returns list:
+        Index entries, as written to ``index.json``.
+    """
+    jobs = []
+    for path in paths:
+        try:
+            mosaic, level, x, y = _parse_quad_filename(path)
+            name = f'{mosaic}-L{level}-{x:04d}E-{y:04d}N'
+        except ValueError:
+            name = os.path.splitext(os.path.basename(path))[0]
+        jobs.append((path, name, path))
+    return _render_all(jobs, output_dir, fmt, size, bands, sample_size,
+                       processes)
+
+
+def mosaic_quicklooks(mosaic, output_dir, bbox=None, region=None, size=256,
+                      fmt='png', bands=None, sample_size=100000,
+                      processes=None):
+    """
+    Render quicklooks for the quads of a ``Mosaic`` within an AOI without
+    downloading them. Only the overviews needed are streamed from each quad.
+
+    :param Mosaic mosaic:
+        The mosaic to render.
+    :param tuple bbox:
+        A (longitude_min, latitude_min, longitude_max, latitude_max) tuple.
+    :param dict region:
+        A GeoJSON geometry in WGS84.
+    """
+    jobs = []
+    for quad in mosaic.quads(bbox, region, lean=True):
+        if quad.downloadable:
+            name = f'{mosaic.name}-L{quad.level}-{quad.x:04d}E-{quad.y:04d}N'
+            jobs.append((quad.download_url, name, name))
+    return _render_all(jobs, output_dir, fmt, size, bands, sample_size,
+                       processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('output_dir')
+    parser.add_argument('quads', nargs='+', help='Downloaded quad files')
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--format', default='png', choices=['png', 'jpg'])
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    entries = quad_quicklooks(args.quads, args.output_dir, size=args.size,
+                              fmt=args.format, processes=args.processes)
+    failed = sum(entry['quicklook'] is None for entry in entries)
+    print(f'Wrote {len(entries) - failed} quicklooks to {args.output_dir} '
+          f'({failed} failed)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+"""
+Reproject web-mercator basemap quads onto an analysis grid (e.g. UTM or an
+equal-area projection) with cached index maps.
+
+Every mosaic in a series uses the same quad grid, so the mapping from target
+pixels to quad pixels only depends on the quad's location and the target
+grid, not on the month. ``WarpCache`` computes that mapping once per
+(quad grid cell, target grid) and stores it on disk; warping a quad is then a
+vectorized gather. ``warp_series`` computes the missing maps and applies them
+to every quad of every mosaic in a process pool.
+"""
+import os
+import hashlib
+import tempfile
+import collections
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from affine import Affine
+from pyproj import Transformer
+from rasterio.crs import CRS
+from rasterio.errors import WindowError
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+
+from quad_store import _parse_quad_filename
+
+
+# Rows of the target window mapped at a time by ``_compute_map``
+STRIP_ROWS = 256
+
+
+class AnalysisGrid(collections.namedtuple('AnalysisGrid',
+                                          'crs transform width height')):
+    """
+    A target grid: CRS (as a string), affine transform (as a 6-tuple) and
+    size in pixels. Hashable, so it can be used as part of a cache key.
+    """
+
+    @classmethod
+    def from_bounds(cls, crs, bounds, resolution):
+        """
+        A north-up grid covering ``bounds`` (left, bottom, right, top in the
+        grid's CRS) with square pixels of ``resolution`` units.
+        """
+        left, bottom, right, top = bounds
+        width = int(np.ceil((right - left) / resolution))
+        height = int(np.ceil((top - bottom) / resolution))
+        transform = Affine(resolution, 0, left, 0, -resolution, top)
+        return cls(CRS.from_user_input(crs).to_string(),
+                   tuple(transform)[:6], width, height)
+
+    @property
+    def affine(self):
+        return Affine(*self.transform)
+
+
+def _source_grid(source):
+    """CRS, transform and shape of a quad without reading its pixels."""
+    with rasterio.open(source) as src:
+        return (src.crs.to_string(), tuple(src.transform)[:6],
+                (src.height, src.width), src.count, src.dtypes[0])
+
+
+def _compute_map(src_crs, src_transform, src_shape, grid, resampling):
+    """
+    Index map from target pixels to source pixels for one quad. Only the
+    window of the target grid covered by the quad is mapped.
+
+    :returns dict:
+        "window" (row_off, col_off, height, width) of the target grid and
+        "index", flat source pixel indexes (-1 outside the quad). Bilinear
+        maps have four indexes per pixel plus "weights".
+    """
+    src_transform = Affine(*src_transform)
+    height, width = src_shape
+    left, top = src_transform * (0, 0)
+    right, bottom = src_transform * (width, height)
+    bounds = transform_bounds(src_crs, grid.crs, left, bottom, right, top,
+                              densify_pts=21)
+
+    full = Window(0, 0, grid.width, grid.height)
+    window = from_bounds(*bounds, transform=grid.affine)
+    col_start, row_start = np.floor([window.col_off, window.row_off])
+    col_stop = np.ceil(window.col_off + window.width)
+    row_stop = np.ceil(window.row_off + window.height)
+    window = Window(col_start, row_start, col_stop - col_start,
+                    row_stop - row_start)
+    try:
+        window = window.intersection(full)
+    except WindowError:
+        return None
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    win_height, win_width = int(window.height), int(window.width)
+    if not win_height or not win_width:
+        return None
+
+    result = {'window': (row_off, col_off, win_height, win_width)}
+    if resampling == 'nearest':
+        index = np.empty((win_height, win_width), dtype=np.int32)
+    elif resampling == 'bilinear':
+        index = np.empty((4, win_height, win_width), dtype=np.int32)
+        weights = np.empty((4, win_height, win_width), dtype=np.float32)
+        result['weights'] = weights
+    else:
+        raise ValueError(f'Unsupported resampling {resampling}')
+    result['index'] = index
+
+    transformer = Transformer.from_crs(grid.crs, src_crs, always_xy=True)
+    inverse = ~src_transform
+    ga, gb, gc, gd, ge, gf = grid.transform
+
+    # Map a strip of rows at a time, so the float64 temporaries stay small
+    for start in range(0, win_height, STRIP_ROWS):
+        stop = min(start + STRIP_ROWS, win_height)
+        strip = slice(start, stop)
+
+        # Target pixel centers, in the target CRS
+        rows, cols = np.mgrid[row_off + start:row_off + stop,
+                              col_off:col_off + win_width] + 0.5
+        xs = ga * cols + gb * rows + gc
+        ys = gd * cols + ge * rows + gf
+        sx, sy = transformer.transform(xs, ys)
+
+        src_cols = inverse.a * sx + inverse.b * sy + inverse.c
+        src_rows = inverse.d * sx + inverse.e * sy + inverse.f
+        inside = ((src_cols >= 0) & (src_cols < width) &
+                  (src_rows >= 0) & (src_rows < height))
+
+        if resampling == 'nearest':
+            flat = (src_rows.astype(np.int64) * width +
+                    src_cols.astype(np.int64))
+            index[strip] = np.where(inside, flat, -1)
+            continue
+
+        # Neighbors relative to pixel centers, clamped at the quad's edges
+        fc, fr = src_cols - 0.5, src_rows - 0.5
+        c0, r0 = np.floor(fc), np.floor(fr)
+        wc, wr = fc - c0, fr - r0
+        c0 = np.clip(c0, 0, width - 1).astype(np.int64)
+        r0 = np.clip(r0, 0, height - 1).astype(np.int64)
+        c1 = np.minimum(c0 + 1, width - 1)
+        r1 = np.minimum(r0 + 1, height - 1)
+
+        neighbors = [(r0, c0, (1 - wr) * (1 - wc)), (r0, c1, (1 - wr) * wc),
+                     (r1, c0, wr * (1 - wc)), (r1, c1, wr * wc)]
+        for k, (r, c, w) in enumerate(neighbors):
+            index[k, strip] = np.where(inside, r * width + c, -1)
+            weights[k, strip] = w
+    return result
+
+
+class WarpCache(object):
+    """
+    On-disk cache of index maps, keyed by the source grid, the target grid
+    and the resampling method. Safe to share between processes.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param str directory:
+            Where to keep the maps. Defaults to a new temporary directory.
+            Use a persistent directory to reuse maps between sessions.
+        """
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='warp-cache-')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def path(self, src_crs, src_transform, src_shape, grid, resampling):
+        key = repr((src_crs, tuple(round(v, 6) for v in src_transform),
+                    tuple(src_shape), tuple(grid), resampling))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f'{digest}.npz')
+
+    def __contains__(self, args):
+        return os.path.exists(self.path(*args))
+
+    def compute(self, src_crs, src_transform, src_shape, grid, resampling):
+        """Compute and store a map. Returns its path."""
+        path = self.path(src_crs, src_transform, src_shape, grid, resampling)
+        result = _compute_map(src_crs, src_transform, src_shape, grid,
+                              resampling)
+        # A unique temp file per writer, so concurrent runs sharing the
+        # cache never write into the same file
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                if result is None:
+                    np.savez(outfile, window=np.zeros(4, dtype=np.int64))
+                else:
+                    np.savez(outfile, **result)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return path
+
+    def load(self, src_crs, src_transform, src_shape, grid, resampling):
+        """Load a map, computing it first if needed. None if no overlap."""
+        args = (src_crs, src_transform, src_shape, grid, resampling)
+        path = self.path(*args)
+        if not os.path.exists(path):
+            self.compute(*args)
+        with np.load(path) as archive:
+            result = {key: archive[key] for key in archive.files}
+        if not result['window'][2:].all():
+            return None
+        return result
+
+
+def _gather(data, valid, warp_map):
+    """Apply an index map to (bands, rows, cols) data and a validity mask."""
+    count = data.shape[0]
+    flat = data.reshape(count, -1)
+    flat_valid = valid.ravel()
+    index = warp_map['index']
+
+    if 'weights' not in warp_map:
+        inside = index >= 0
+        out = np.zeros((count,) + index.shape, dtype=data.dtype)
+        out[:, inside] = flat[:, index[inside]]
+        out_valid = np.zeros(index.shape, dtype=bool)
+        out_valid[inside] = flat_valid[index[inside]]
+        return out, out_valid
+
+    inside = index[0] >= 0
+    safe = np.where(index >= 0, index, 0)
+    weights = warp_map['weights'] * flat_valid[safe]
+    total = weights.sum(axis=0)
+    out_valid = inside & (total > 0)
+
+    # One neighbor at a time, so only a (bands, rows, cols) copy is live
+    values = np.zeros((count,) + index.shape[1:], dtype=np.float32)
+    for k in range(len(index)):
+        values += flat[:, safe[k]] * weights[k]
+    values /= np.where(out_valid, total, 1)
+    out = np.where(out_valid, np.round(values), 0).astype(data.dtype)
+    return out, out_valid
+
+
+def _warp_quad(job, grid, resampling, cache_dir):
+    """Warp one quad using a cached map. Runs in a worker."""
+    source, (src_crs, src_transform, src_shape, _, _) = job
+    warp_map = WarpCache(cache_dir).load(src_crs, src_transform, src_shape,
+                                         grid, resampling)
+    if warp_map is None:
+        return None
+
+    with rasterio.open(source) as src:
+        data = src.read()
+        valid = src.dataset_mask() > 0
+    out, out_valid = _gather(data, valid, warp_map)
+    return tuple(int(v) for v in warp_map['window']), out, out_valid
+
+
+def _compute(location, grid, resampling, cache_dir):
+    WarpCache(cache_dir).compute(*location, grid, resampling)
+
+
+def _group_by_mosaic(paths):
+    groups = collections.OrderedDict()
+    for path in paths:
+        mosaic = _parse_quad_filename(path)[0]
+        groups.setdefault(mosaic, []).append(path)
+    return groups
+
+
+def warp_series(sources, grid, resampling='nearest', cache=None,
+                processes=None):
+    """
+    Warp the quads of one or more mosaics onto an analysis grid. Index maps
+    are computed once per quad location (in parallel) and reused for every
+    mosaic, so adding more months only adds gather work.
+
+    :param sources:
+        Either a dict of mosaic name to quad paths/URLs, or an iterable of
+        downloaded quad paths (grouped by mosaic based on their filenames or
+        directories, as written by ``MosaicSeries.download_quads``).
+    :param AnalysisGrid grid:
+        The target grid.
+    :param str resampling:
+        "nearest" or "bilinear". Bilinear ignores invalid (alpha = 0)
+        neighbors.
+    :param WarpCache cache:
+        Cache of index maps. A temporary one is used if not specified.
+    :param int processes:
+        Number of worker processes. Defaults to the number of CPUs.
+
+    :returns dict:
+        Mosaic name to a (data, valid) tuple, where data is a
+        (bands, height, width) array on the target grid and valid is a
+        boolean mask of pixels with data.
+    """
+    if not isinstance(sources, dict):
+        sources = _group_by_mosaic(sources)
+    if cache is None:
+        cache = WarpCache()
+
+    jobs = [(name, source) for name, paths in sources.items()
+            for source in paths]
+    if not jobs:
+        return {}
+
+    with ProcessPoolExecutor(processes) as executor:
+        infos = list(executor.map(_source_grid,
+                                  [source for _, source in jobs]))
+
+        # One map per unique quad location, however many months there are
+        locations = {info[:3] for info in infos}
+        missing = [loc for loc in locations
+                   if (loc + (grid, resampling)) not in cache]
+        func = partial(_compute, grid=grid, resampling=resampling,
+                       cache_dir=cache.directory)
+        list(executor.map(func, missing))
+
+        outputs = {}
+        func = partial(_warp_quad, grid=grid, resampling=resampling,
+                       cache_dir=cache.directory)
+        warped = executor.map(func, zip([source for _, source in jobs], infos))
+        for (name, _), info, result in zip(jobs, infos, warped):
+            if name not in outputs:
+                count, dtype = info[3], info[4]
+                outputs[name] = (
+                    np.zeros((count, grid.height, grid.width), dtype=dtype),
+                    np.zeros((grid.height, grid.width), dtype=bool),
+                )
+            if result is None:
+                continue
+
+            (row_off, col_off, height, width), out, out_valid = result
+            data, valid = outputs[name]
+            rows = slice(row_off, row_off + height)
+            cols = slice(col_off, col_off + width)
+            data[:, rows, cols][:, out_valid] = out[:, out_valid]
+            valid[rows, cols] |= out_valid
+
+    return outputs
@@ -0,0 +1,273 @@
+"""
+A local ``{z}/{x}/{y}`` tile pyramid built from downloaded basemap quads.
+
+Quads are cut into 256x256 full-bit-depth GeoTIFF tiles on the same
+web-mercator grid as the tiles.planet.com ``gmap`` URLs, and lower zoom levels
+are built by downsampling in a process pool. ``TilePyramid.serve`` starts a
+small HTTP server for the pyramid and ``TilePyramid.tileserver_xml`` returns a
+GDAL XML description compatible with ``Mosaic.tileserver_xml``, so existing
+rasterio/GDAL code can read from local disk instead of the network.
+"""
+import os
+import glob
+import json
+import math
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+
+from basemaps_client import FULL_BIT_DEPTH_XML
+
+
+TILE_SIZE = 256
+
+# Half the width of the web-mercator world in meters
+WORLD = 20037508.342789244
+
+# rasterio dtype names that differ from GDAL's
+GDAL_DATATYPES = {'uint8': 'Byte', 'int8': 'Int8'}
+
+
+def _tile_span(zoom):
+    return 2 * WORLD / 2 ** zoom
+
+
+def _tile_bounds(z, x, y):
+    span = _tile_span(z)
+    left, top = -WORLD + x * span, WORLD - y * span
+    return left, top - span, left + span, top
+
+
+def _zoom_for_resolution(resolution):
+    return int(round(math.log2(2 * WORLD / (TILE_SIZE * resolution))))
+
+
+def _tile_path(root, z, x, y):
+    return os.path.join(root, str(z), str(x), f'{y}.tif')
+
+
+def _write_tile(root, z, x, y, data):
+    filename = _tile_path(root, z, x, y)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    count, height, width = data.shape
+    transform = from_bounds(*_tile_bounds(z, x, y), width, height)
+    with rasterio.open(filename, 'w', driver='GTiff', width=width,
+                       height=height, count=count, dtype=data.dtype,
+                       crs='EPSG:3857', transform=transform) as dst:
+        dst.write(data)
+
+
+def _cut_quad(path, root):
+    """Cut one quad into tiles at its native zoom. Runs in a worker."""
+    with rasterio.open(path) as src:
+        zoom = _zoom_for_resolution(src.res[0])
+        span = _tile_span(zoom)
+        x0 = int(round((src.transform.c + WORLD) / span))
+        y0 = int(round((WORLD - src.transform.f) / span))
+        data = src.read()
+        valid = src.dataset_mask() > 0
+        info = {'zoom': zoom, 'count': src.count, 'dtype': data.dtype.name}
+
+    tiles = []
+    _, height, width = data.shape
+    for j in range(height // TILE_SIZE):
+        for i in range(width // TILE_SIZE):
+            rows = slice(j * TILE_SIZE, (j + 1) * TILE_SIZE)
+            cols = slice(i * TILE_SIZE, (i + 1) * TILE_SIZE)
+            if not valid[rows, cols].any():
+                # Don't write empty tiles; the server will 404 them instead
+                continue
+            _write_tile(root, zoom, x0 + i, y0 + j, data[:, rows, cols])
+            tiles.append((x0 + i, y0 + j))
+    return info, tiles
+
+
+def _downsample(root, z, tile, count, dtype):
+    """
+    Build a tile at zoom ``z`` from its four children at ``z + 1``. The last
+    band is treated as alpha; other bands are averaged over valid pixels.
+    Runs in a worker.
+    """
+    x, y = tile
+    canvas = np.zeros((count, 2 * TILE_SIZE, 2 * TILE_SIZE), dtype=dtype)
+    for dx in (0, 1):
+        for dy in (0, 1):
+            filename = _tile_path(root, z + 1, 2 * x + dx, 2 * y + dy)
+            if os.path.exists(filename):
+                with rasterio.open(filename) as src:
+                    rows = slice(dy * TILE_SIZE, (dy + 1) * TILE_SIZE)
+                    cols = slice(dx * TILE_SIZE, (dx + 1) * TILE_SIZE)
+                    canvas[:, rows, cols] = src.read()
+
+    blocks = canvas.reshape(count, TILE_SIZE, 2, TILE_SIZE, 2)
+    alpha = blocks[-1]
+    weights = (alpha > 0).sum(axis=(1, 3))
+    if not weights.any():
+        return False
+
+    total = (blocks[:-1] * (alpha > 0)).sum(axis=(2, 4), dtype=np.float64)
+    mean = np.where(weights > 0, total / np.maximum(weights, 1), 0)
+
+    out = np.empty((count, TILE_SIZE, TILE_SIZE), dtype=dtype)
+    out[:-1] = np.round(mean).astype(dtype)
+    out[-1] = alpha.max(axis=(1, 3))
+    _write_tile(root, z, x, y, out)
+    return True
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    """Static file handler that doesn't log every tile request."""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TilePyramid(object):
+    """A directory of ``{z}/{x}/{y}.tif`` tiles plus a ``pyramid.json``."""
+
+    metadata_name = 'pyramid.json'
+
+    def __init__(self, root):
+        """
+        :param str root:
+            Directory for the pyramid. Created if it does not exist.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.server = None
+
+        self.metadata = {}
+        if os.path.exists(self._metadata_path):
+            with open(self._metadata_path) as infile:
+                self.metadata = json.load(infile)
+
+    @property
+    def _metadata_path(self):
+        return os.path.join(self.root, self.metadata_name)
+
+    def _tiles(self, z):
+        pattern = os.path.join(self.root, str(z), '*', '*.tif')
+        for filename in glob.glob(pattern):
+            x = os.path.basename(os.path.dirname(filename))
+            y = os.path.splitext(os.path.basename(filename))[0]
+            yield int(x), int(y)
+
+    def build(self, paths, min_zoom=0, processes=None):
+        """
+        Build the pyramid from downloaded quads.
+
+        :param iterable paths:
+            Quad filenames, e.g. the output of ``Mosaic.download_quads``. All
+            quads must come from the same mosaic (or at least share a zoom
+            level, band count and datatype).
+        :param int min_zoom:
+            Lowest zoom level to build.
+        :param int processes:
+            Number of worker processes. Defaults to the number of CPUs.
+
+        :returns dict:
+            Pyramid metadata (zoom range, band count, datatype).
+        """
+        paths = list(paths)
+        if not paths:
+            raise ValueError('No quads to build a pyramid from!')
+
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(partial(_cut_quad, root=self.root),
+                                        paths))
+            infos = {tuple(sorted(info.items())) for info, _ in results}
+            if len(infos) > 1:
+                raise ValueError('Quads have mixed zoom levels or band types!')
+            info = results[0][0]
+
+            for z in range(info['zoom'] - 1, min_zoom - 1, -1):
+                parents = sorted({(x // 2, y // 2)
+                                  for x, y in self._tiles(z + 1)})
+                func = partial(_downsample, self.root, z,
+                               count=info['count'], dtype=info['dtype'])
+                list(executor.map(func, parents, chunksize=64))
+
+        self.metadata = {
+            'minzoom': min_zoom,
+            'maxzoom': info['zoom'],
+            'count': info['count'],
+            'dtype': info['dtype'],
+        }
+        with open(self._metadata_path, 'w') as outfile:
+            json.dump(self.metadata, outfile)
+        return self.metadata
+
+    def serve(self, host='127.0.0.1', port=0):
+        """
+        Serve the pyramid over HTTP from a background thread. Missing tiles
+        return 404, which the GDAL XML treats as empty.
+
+        :param int port:
+            Port to listen on. By default a free port is chosen.
+
+        :returns str:
+            The base URL of the server.
+        """
+        if self.server is None:
+            handler = partial(_QuietHandler, directory=self.root)
+            self.server = ThreadingHTTPServer((host, port), handler)
+            thread = threading.Thread(target=self.server.serve_forever,
+                                      daemon=True)
+            thread.start()
+        return self.url
+
+    def shutdown(self):
+        """Stop the tile server, if running."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def url(self):
+        """Base URL of the running tile server."""
+        if self.server is None:
+            return None
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def tileserver_xml(self, level=None, band_count=None):
+        """
+        An XML description of the pyramid in the same form as
+        ``Mosaic.tileserver_xml``, pointing at the local tile server (which is
+        started if needed). Directly openable by rasterio and gdal.
+
+        :param int level:
+            Base level to use. Defaults to the pyramid's maximum zoom.
+        :param int band_count:
+            Override the band count recorded when the pyramid was built.
+        """
+        self.serve()
+        if level is None:
+            level = self.metadata['maxzoom']
+        if band_count is None:
+            band_count = self.metadata['count']
+
+        dtype = self.metadata['dtype']
+        max_val = '255' if dtype == 'uint8' else '10000'
+        max_alpha = '255' if dtype == 'uint8' else '65535'
+        maxs = ' '.join((band_count - 1) * [max_val] + [max_alpha])
+        mins = ' '.join(band_count * ['0'])
+        nodata = ' '.join(band_count * ['0'])
+
+        return FULL_BIT_DEPTH_XML.format(
+                api_key='',
+                datatype=GDAL_DATATYPES.get(dtype, dtype),
+                extra='',
+                level=level,
+                maxs=maxs,
+                mins=mins,
+                nbands=band_count,
+                nodata=nodata,
+                tileserver=f'{self.url}/${{z}}/${{x}}/${{y}}.tif',
+        )
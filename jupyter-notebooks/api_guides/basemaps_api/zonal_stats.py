@@ -0,0 +1,276 @@
+"""
+Per-polygon statistics over basemap mosaics, read quad by quad.
+
+Polygons are grouped by the quads they intersect so each quad is opened once,
+and only the window covering its polygons is read (quads are streamed as
+COGs, so nothing is downloaded in full). The quads a polygon touches are
+worked out from the quad grid, so only those quads are listed. Each quad is processed in a worker
+process: polygons are rasterized against the block that was read and
+reduced to statistics there. Polygons that straddle quad boundaries have
+their pixels gathered from every quad and are reduced at the end.
+"""
+import re
+import math
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.warp import transform_geom
+from rasterio.errors import WindowError
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import transform as window_transform
+
+
+PERCENTILE = re.compile(r'^p(\d+(?:\.\d+)?)$')
+
+# Quads are QUAD_SIZE pixels on a side, on the web-mercator grid of the
+# mosaic's level. WORLD is half the width of that grid in meters.
+QUAD_SIZE = 4096
+WORLD = 20037508.342789244
+
+
+def _geometry(feature):
+    """Accept either a GeoJSON feature or a bare geometry."""
+    return feature.get('geometry', feature)
+
+
+def _bounds(geometry):
+    """Lon/lat bounds of a GeoJSON geometry without needing shapely."""
+    coords = np.array(list(_flatten(geometry['coordinates'])), dtype=float)
+    xmin, ymin = coords.min(axis=0)
+    xmax, ymax = coords.max(axis=0)
+    return xmin, ymin, xmax, ymax
+
+
+def _flatten(coords):
+    if isinstance(coords[0], (int, float)):
+        yield coords[:2]
+    else:
+        for item in coords:
+            yield from _flatten(item)
+
+
+def _quad_span(level):
+    """Width of a quad in web-mercator meters."""
+    return 2 * WORLD * QUAD_SIZE / (256 * 2 ** level)
+
+
+def _to_mercator(lon, lat):
+    x = WORLD * lon / 180
+    y = WORLD / math.pi * math.log(math.tan(math.pi / 4 +
+                                            math.radians(lat) / 2))
+    return x, y
+
+
+def _to_lonlat(x, y):
+    lon = 180 * x / WORLD
+    lat = math.degrees(math.atan(math.sinh(math.pi * y / WORLD)))
+    return lon, lat
+
+
+def _cells(bounds, span):
+    """(column, row) quad grid cells touched by web-mercator bounds."""
+    xmin, ymin, xmax, ymax = bounds
+    cols = range(int((xmin + WORLD) // span), int((xmax + WORLD) // span) + 1)
+    rows = range(int((WORLD - ymax) // span), int((WORLD - ymin) // span) + 1)
+    return [(col, row) for col in cols for row in rows]
+
+
+def _quad_cell(quad, span):
+    """Grid cell of a quad, from the center of its lon/lat bounds."""
+    xmin, ymin = _to_mercator(*quad.bounds[:2])
+    xmax, ymax = _to_mercator(*quad.bounds[2:])
+    return _cells(((xmin + xmax) / 2, (ymin + ymax) / 2) * 2, span)[0]
+
+
+def _cell_searches(cells, span):
+    """
+    Lon/lat bboxes covering runs of adjacent cells within each row, inset
+    slightly so that a search only returns the quads in those cells.
+    """
+    inset = span / 100
+    by_row = {}
+    for col, row in cells:
+        by_row.setdefault(row, []).append(col)
+    for row, cols in sorted(by_row.items()):
+        cols.sort()
+        runs = [[cols[0], cols[0]]]
+        for col in cols[1:]:
+            if col == runs[-1][1] + 1:
+                runs[-1][1] = col
+            else:
+                runs.append([col, col])
+        top = WORLD - row * span
+        for first, last in runs:
+            west, south = _to_lonlat(-WORLD + first * span + inset,
+                                     top - span + inset)
+            east, north = _to_lonlat(-WORLD + (last + 1) * span - inset,
+                                     top - inset)
+            yield west, south, east, north
+
+
+def _outer_window(window):
+    """Round a window outwards to whole pixels (floor start, ceil stop)."""
+    col_start, row_start = np.floor([window.col_off, window.row_off])
+    col_stop = np.ceil(window.col_off + window.width)
+    row_stop = np.ceil(window.row_off + window.height)
+    return Window(int(col_start), int(row_start), int(col_stop - col_start),
+                  int(row_stop - row_start))
+
+
+def _clip_window(bounds, transform, extent):
+    """Pixel window covering ``bounds``, clipped to the ``extent`` window."""
+    window = _outer_window(from_bounds(*bounds, transform))
+    try:
+        return window.intersection(extent)
+    except WindowError:
+        # Only touches the extent's edge
+        return Window(0, 0, 0, 0)
+
+
+def _reduce(values, stats, bins=None):
+    """Reduce a 1-d array of pixel values to the requested statistics."""
+    result = {}
+    for stat in stats:
+        match = PERCENTILE.match(stat)
+        if stat == 'count':
+            result[stat] = int(values.size)
+        elif values.size == 0:
+            result[stat] = None
+        elif stat == 'mean':
+            result[stat] = float(values.mean())
+        elif stat == 'std':
+            result[stat] = float(values.std())
+        elif stat == 'min':
+            result[stat] = float(values.min())
+        elif stat == 'max':
+            result[stat] = float(values.max())
+        elif stat == 'median':
+            result[stat] = float(np.median(values))
+        elif match:
+            result[stat] = float(np.percentile(values, float(match.group(1))))
+        elif stat == 'histogram':
+            counts, _ = np.histogram(values, bins=bins)
+            result[stat] = counts.tolist()
+        else:
+            raise ValueError(f'Unknown statistic {stat}')
+    return result
+
+
+def _quad_stats(job, bands, stats, bins):
+    """
+    Read the window of a quad covering its polygons and compute statistics.
+    Runs in a worker. Returns {feature index: {band: stats or values}}, with
+    raw values for polygons that are split across quads.
+    """
+    url, features = job
+    output = {}
+    with rasterio.open(url) as src:
+        full = Window(0, 0, src.width, src.height)
+        left = min(geom_bounds[0] for _, _, geom_bounds, _ in features)
+        bottom = min(geom_bounds[1] for _, _, geom_bounds, _ in features)
+        right = max(geom_bounds[2] for _, _, geom_bounds, _ in features)
+        top = max(geom_bounds[3] for _, _, geom_bounds, _ in features)
+        # Round outwards so partially covered edge pixels are read
+        window = _clip_window((left, bottom, right, top), src.transform, full)
+
+        data = src.read(bands, window=window)
+        valid = src.dataset_mask(window=window) > 0
+        transform = src.window_transform(window)
+
+    # Each polygon is only rasterized over its own part of the block
+    block = Window(0, 0, valid.shape[1], valid.shape[0])
+    for index, geometry, geom_bounds, split in features:
+        sub = _clip_window(geom_bounds, transform, block)
+        rows, cols = sub.toslices()
+        sub_valid = valid[rows, cols]
+        if sub_valid.size:
+            inside = ~geometry_mask([geometry], sub_valid.shape,
+                                    window_transform(sub, transform))
+            pixels = data[:, rows, cols][:, inside & sub_valid]
+        else:
+            pixels = np.empty((len(bands), 0), dtype=data.dtype)
+        if split:
+            output[index] = dict(zip(bands, pixels))
+        else:
+            output[index] = {band: _reduce(values, stats, bins)
+                             for band, values in zip(bands, pixels)}
+    return output
+
+
+def zonal_stats(mosaic, features, bands=None, stats=('count', 'mean'),
+                bins=None, processes=None):
+    """
+    Compute per-polygon statistics for a mosaic. See ``Mosaic.zonal_stats``.
+    """
+    features = list(features)
+    geometries = [_geometry(feature) for feature in features]
+    if not geometries:
+        return {'id': []}
+
+    ids = [feature.get('id', i) if 'geometry' in feature else i
+           for i, feature in enumerate(features)]
+    if bands is None:
+        # Everything but alpha
+        bands = list(range(1, mosaic.nbands))
+    if 'histogram' in stats and bins is None:
+        max_val = 255 if mosaic.datatype == 'byte' else 10000
+        bins = np.linspace(0, max_val, 65)
+
+    mercator = [transform_geom('EPSG:4326', 'EPSG:3857', geometry)
+                for geometry in geometries]
+    mercator_bounds = [_bounds(geometry) for geometry in mercator]
+
+    # Polygons by the quad grid cells they touch, so the work scales with
+    # the quads touched rather than with polygons x quads in their extent
+    span = _quad_span(mosaic.level)
+    cells = {}
+    for i, bounds in enumerate(mercator_bounds):
+        for cell in _cells(bounds, span):
+            cells.setdefault(cell, []).append(i)
+
+    groups, seen = [], set()
+    for bbox in _cell_searches(cells, span):
+        for quad in mosaic.quads(bbox=bbox, lean=True):
+            if not quad.downloadable or quad.id in seen:
+                continue
+            seen.add(quad.id)
+            hits = cells.get(_quad_cell(quad, span))
+            if hits:
+                groups.append((quad.download_url, hits))
+
+    nquads = np.zeros(len(geometries), dtype=int)
+    for _, hits in groups:
+        nquads[hits] += 1
+
+    jobs = [(url, [(i, mercator[i], mercator_bounds[i], nquads[i] > 1)
+                   for i in hits])
+            for url, hits in groups]
+
+    whole, split = {}, {}
+    func = partial(_quad_stats, bands=bands, stats=stats, bins=bins)
+    with ProcessPoolExecutor(processes) as executor:
+        for output in executor.map(func, jobs):
+            for index, result in output.items():
+                if nquads[index] > 1:
+                    split.setdefault(index, []).append(result)
+                else:
+                    whole[index] = result
+
+    for index, parts in split.items():
+        whole[index] = {
+            band: _reduce(np.concatenate([part[band] for part in parts]),
+                          stats, bins)
+            for band in bands
+        }
+
+    empty = {band: _reduce(np.array([]), stats, bins) for band in bands}
+    table = {'id': ids, 'quads': nquads.tolist()}
+    for band in bands:
+        for stat in stats:
+            table[f'b{band}_{stat}'] = [
+                whole.get(i, empty)[band][stat] for i in range(len(ids))
+            ]
+    return table
@@ -0,0 +1,175 @@
+"""Window-by-window UDM2 masking for many scenes at once.
+
+The per-pixel usability classes in UDM2 bands 1-6 are bit-packed into a
+single byte and looked up in a 64-entry table, so any combination of classes
+becomes one mask in a single pass. Scenes are read block by block, which lets
+us compute the usable fraction of a scene (and skip it) before the analytic
+bands are ever read.
+"""
+import os
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import rasterio
+
+
+# Names of UDM2 bands 1-6, in band order. Bit i of a packed pixel is band i+1.
+udm2_classes = ['clear', 'snow', 'shadow', 'light haze', 'heavy haze', 'cloud']
+
+CONFIDENCE_BAND = 7
+UNUSABLE_BAND = 8
+
+default_mask_classes = ('snow', 'shadow', 'light haze', 'heavy haze', 'cloud')
+
+
+def udm2_lut(mask_classes=default_mask_classes, require_clear=True):
+    """Lookup table from packed UDM2 class bits to "unusable".
+
+    :param mask_classes: class names (from udm2_classes) to mask
+    :param require_clear: also mask pixels not flagged as clear
+    :returns: boolean array of length 64, True where the pixel is unusable
+    """
+    codes = np.arange(64, dtype=np.uint8)
+    lut = np.zeros(64, dtype=bool)
+    for name in mask_classes:
+        lut |= (codes & (1 << udm2_classes.index(name))) != 0
+    if require_clear:
+        lut |= (codes & 1) == 0
+    return lut
+
+
+def _window_masks(src, window, lut, min_confidence=None):
+    """Returns (unusable, blackfill) masks for one window of an open UDM2."""
+    classes = src.read(list(range(1, 7)), window=window)
+    packed = np.packbits(classes != 0, axis=0, bitorder='little')[0]
+    unusable = lut[packed]
+
+    # bit 0 of the UDM band is blackfill, i.e. outside the scene footprint
+    blackfill = (src.read(UNUSABLE_BAND, window=window) & 1) != 0
+    unusable |= blackfill
+
+    if min_confidence is not None:
+        unusable |= src.read(CONFIDENCE_BAND, window=window) < min_confidence
+
+    return unusable, blackfill
+
+
+def _fraction(num_usable, num_valid):
+    return num_usable / num_valid if num_valid else 0.0
+
+
+def usable_fraction(udm2_filename, lut=None, min_confidence=None):
+    """Fraction of in-footprint pixels that are usable, computed block by
+    block without holding the full UDM2 in memory.
+    """
+    if lut is None:
+        lut = udm2_lut()
+
+    num_usable = num_valid = 0
+    with rasterio.open(udm2_filename) as src:
+        for _, window in src.block_windows(1):
+            unusable, blackfill = _window_masks(src, window, lut,
+                                                min_confidence)
+            num_valid += blackfill.size - np.count_nonzero(blackfill)
+            num_usable += unusable.size - np.count_nonzero(unusable)
+    return _fraction(num_usable, num_valid)
+
+
+def udm2_mask(udm2_filename, lut=None, min_confidence=None):
+    """Combined unusable-pixel mask for a scene.
+
+    :returns: (mask, usable fraction), mask is True for unusable pixels
+    """
+    if lut is None:
+        lut = udm2_lut()
+
+    num_usable = num_valid = 0
+    with rasterio.open(udm2_filename) as src:
+        mask = np.empty((src.height, src.width), dtype=bool)
+        for _, window in src.block_windows(1):
+            unusable, blackfill = _window_masks(src, window, lut,
+                                                min_confidence)
+            mask[window.toslices()] = unusable
+            num_valid += blackfill.size - np.count_nonzero(blackfill)
+            num_usable += unusable.size - np.count_nonzero(unusable)
+    return mask, _fraction(num_usable, num_valid)
+
+
+def load_masked_bands(analytic_filename, udm2_filename, lut=None,
+                      min_confidence=None, min_usable=None):
+    """Loads analytic bands as masked arrays sharing the UDM2 mask.
+
+    The UDM2 is read first; if the usable fraction is below min_usable the
+    analytic asset is never opened.
+
+    :returns: (usable fraction, list of masked bands or None if skipped)
+    """
+    mask, fraction = udm2_mask(udm2_filename, lut, min_confidence)
+    if min_usable is not None and fraction < min_usable:
+        return fraction, None
+
+    with rasterio.open(analytic_filename) as src:
+        if (src.height, src.width) != mask.shape:
+            msg = '{} and {} are not on the same grid'.format(
+                analytic_filename, udm2_filename)
+            raise ValueError(msg)
+
+        bands = np.empty((src.count, src.height, src.width),
+                         dtype=src.dtypes[0])
+        for _, window in src.block_windows(1):
+            slices = window.toslices()
+            bands[(slice(None),) + slices] = src.read(window=window)
+            # 0 value means the pixel is masked
+            mask[slices] |= src.read_masks(1, window=window) == 0
+
+    # bands share the same mask, as in visual._mask_bands
+    return fraction, [np.ma.array(b, mask=mask) for b in bands]
+
+
+def usable_fractions(udm2_filenames, mask_classes=default_mask_classes,
+                     require_clear=True, min_confidence=None, processes=None):
+    """Usable fraction of each scene, computed in a process pool.
+
+    :returns: dict of udm2 filename to usable fraction
+    """
+    udm2_filenames = list(udm2_filenames)
+    lut = udm2_lut(mask_classes, require_clear)
+    func = partial(usable_fraction, lut=lut, min_confidence=min_confidence)
+    with ProcessPoolExecutor(processes) as executor:
+        return dict(zip(udm2_filenames, executor.map(func, udm2_filenames)))
+
+
+def _load_scene(scene, lut, min_confidence, min_usable):
+    analytic_filename, udm2_filename = scene
+    return load_masked_bands(analytic_filename, udm2_filename, lut,
+                             min_confidence, min_usable)
+
+
+def mask_scenes(scenes, mask_classes=default_mask_classes, require_clear=True,
+                min_confidence=None, min_usable=None, processes=None):
+    """Masks many scenes in a process pool.
+
+    :param scenes: iterable of (analytic filename, udm2 filename) pairs
+    :param min_usable: skip scenes whose usable fraction is below this,
+        without reading their analytic bands
+    :returns: generator of (analytic filename, usable fraction, masked bands)
+        in input order. Masked bands is None for skipped scenes.
+    """
+    lut = udm2_lut(mask_classes, require_clear)
+    func = partial(_load_scene, lut=lut, min_confidence=min_confidence,
+                   min_usable=min_usable)
+    # Only keep a couple of scenes per worker in flight, so finished scenes
+    # don't pile up in memory while the caller works through earlier ones
+    max_pending = 2 * (processes or os.cpu_count())
+    pending = collections.deque()
+    with ProcessPoolExecutor(processes) as executor:
+        for scene in scenes:
+            if len(pending) >= max_pending:
+                analytic_filename, future = pending.popleft()
+                yield (analytic_filename,) + future.result()
+            pending.append((scene[0], executor.submit(func, scene)))
+        while pending:
+            analytic_filename, future = pending.popleft()
+            yield (analytic_filename,) + future.result()